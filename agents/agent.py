@@ -1,19 +1,27 @@
 import os
+import gc
+import math
 import asyncio
 import base64
-import tempfile
+import hashlib
+import threading
+import importlib.util
+import httpx
 import requests
-import dashscope
 import streamlit as st
 from PIL import Image
-from typing import Optional, List, Dict, TypedDict
+from collections import OrderedDict, deque
+from typing import Any, Optional, List, Dict, Deque, Tuple, TypedDict
 from dataclasses import dataclass
-from langchain_openai import AzureChatOpenAI
+from pydantic import BaseModel, Field
+from langchain_openai import AzureChatOpenAI, AzureOpenAIEmbeddings
 from langchain_core.messages import HumanMessage
-from pdf2image import convert_from_path
-from langgraph.graph import StateGraph
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.caches import InMemoryCache
+from langchain_core.globals import get_llm_cache, set_llm_cache
 from io import BytesIO
 from dotenv import load_dotenv
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
 
 # Load environment variables
 load_dotenv()
@@ -21,6 +29,10 @@ load_dotenv()
 AZURE_OAI_API_KEY = os.getenv("AZURE_OAI_API_KEY")
 AZURE_OPENAI_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT", "https://derma-lab-test.openai.azure.com")
 DASHSCOPE_API_KEY = os.getenv("DASHSCOPE_API_KEY")
+# Optional: enables the semantic specialist cache when set
+AZURE_OPENAI_EMBEDDING_DEPLOYMENT = os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT")
+# Optional: persist the exact-match LLM cache to this SQLite file across restarts
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH")
 
 if not AZURE_OAI_API_KEY:
     raise ValueError("AZURE_OAI_API_KEY not found in environment variables")
@@ -28,32 +40,246 @@ if not AZURE_OAI_API_KEY:
 if not DASHSCOPE_API_KEY:
     raise ValueError("DASHSCOPE_API_KEY not found in environment variables")
 
-dashscope.api_key = DASHSCOPE_API_KEY
+# Pooled connections are bound to the loop that opened them, so each browser session gets
+# its own event loop and connection pool. Sessions then run consultations concurrently
+# instead of queueing on one process-wide loop.
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    if "event_loop" not in st.session_state:
+        st.session_state.event_loop = asyncio.new_event_loop()
+    return st.session_state.event_loop
+
+def get_http_async_client() -> httpx.AsyncClient:
+    # One keep-alive pool for every Azure call in this session, so concurrent requests share
+    # TLS connections. HTTP/2 needs the optional h2 package (httpx[http2]).
+    if "http_async_client" not in st.session_state:
+        st.session_state.http_async_client = httpx.AsyncClient(
+            http2=importlib.util.find_spec("h2") is not None,
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=32),
+            timeout=60.0
+        )
+    return st.session_state.http_async_client
 
 def initialize_azure_client(deployment_name="gpt-4o-mini"):
-    return AzureChatOpenAI(
-        api_key=AZURE_OAI_API_KEY,
-        azure_endpoint=AZURE_OPENAI_ENDPOINT,
-        deployment_name=deployment_name,
-        api_version="2024-02-15-preview",
-        temperature=0.7
-    )
+    key = f"azure_client_{deployment_name}"
+    if key not in st.session_state:
+        st.session_state[key] = AzureChatOpenAI(
+            api_key=AZURE_OAI_API_KEY,
+            azure_endpoint=AZURE_OPENAI_ENDPOINT,
+            deployment_name=deployment_name,
+            api_version="2024-02-15-preview",
+            temperature=0.7,
+            http_async_client=get_http_async_client()
+        )
+    return st.session_state[key]
 
 client = initialize_azure_client()
 
+# Exact-match response cache shared by every client.ainvoke. Streamlit re-executes
+# this script on each interaction, so only install it once per process.
+if get_llm_cache() is None:
+    if LLM_CACHE_PATH:
+        # Opt-in: this writes patient prompts and answers to disk
+        from langchain_community.cache import SQLiteCache
+        set_llm_cache(SQLiteCache(database_path=LLM_CACHE_PATH))
+    else:
+        set_llm_cache(InMemoryCache())
+
+### Semantic specialist cache ###
+SEMANTIC_CACHE_THRESHOLD = 0.90
+# Per-namespace bound; the oldest entries are evicted first
+SEMANTIC_CACHE_MAX_ENTRIES = 256
+# Fields that must match exactly before a semantic hit is accepted; a near-identical case
+# with different medications or allergies can still embed above the threshold
+CASE_GUARD_FIELDS = ("age", "gender", "conditions", "medications", "allergies")
+
+class SemanticCache:
+    """Reuses a specialist response when a new case embeds close enough to an earlier one
+    and its guard fields match exactly. Shared by every session thread, so guarded by a lock."""
+
+    def __init__(self, threshold: float = SEMANTIC_CACHE_THRESHOLD, max_entries: int = SEMANTIC_CACHE_MAX_ENTRIES):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.vectors: OrderedDict[str, List[float]] = OrderedDict()
+        self.entries: Dict[str, Deque[Tuple[List[float], Tuple[str, ...], str]]] = {}
+
+    async def embed(self, text: str, embeddings: AzureOpenAIEmbeddings) -> List[float]:
+        with self.lock:
+            vector = self.vectors.get(text)
+            if vector is not None:
+                self.vectors.move_to_end(text)
+        if vector is None:
+            vector = await embeddings.aembed_query(text)
+            with self.lock:
+                self.vectors[text] = vector
+                if len(self.vectors) > self.max_entries:
+                    self.vectors.popitem(last=False)
+        return vector
+
+    async def lookup(self, text: str, guard: Tuple[str, ...], namespace: str, embeddings: AzureOpenAIEmbeddings) -> Optional[str]:
+        vector = await self.embed(text, embeddings)
+        with self.lock:
+            candidates = list(self.entries.get(namespace, ()))
+        best_response, best_similarity = None, self.threshold
+        for cached_vector, cached_guard, response in candidates:
+            if cached_guard != guard:
+                continue
+            similarity = cosine_similarity(vector, cached_vector)
+            if similarity >= best_similarity:
+                best_response, best_similarity = response, similarity
+        return best_response
+
+    async def store(self, text: str, guard: Tuple[str, ...], namespace: str, response: str, embeddings: AzureOpenAIEmbeddings) -> None:
+        vector = await self.embed(text, embeddings)
+        with self.lock:
+            self.entries.setdefault(namespace, deque(maxlen=self.max_entries)).append((vector, guard, response))
+
+def cosine_similarity(a: List[float], b: List[float]) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+# The cached entries are shared by every session; the embeddings client is per session
+# because it uses the session's connection pool
+@st.cache_resource
+def get_semantic_cache() -> Optional[SemanticCache]:
+    if not AZURE_OPENAI_EMBEDDING_DEPLOYMENT:
+        return None
+    return SemanticCache()
+
+def get_embeddings() -> AzureOpenAIEmbeddings:
+    if "embeddings" not in st.session_state:
+        st.session_state.embeddings = AzureOpenAIEmbeddings(
+            api_key=AZURE_OAI_API_KEY,
+            azure_endpoint=AZURE_OPENAI_ENDPOINT,
+            deployment=AZURE_OPENAI_EMBEDDING_DEPLOYMENT,
+            api_version="2024-02-15-preview",
+            http_async_client=get_http_async_client()
+        )
+    return st.session_state.embeddings
+
+async def stream_completion(messages: List[HumanMessage], placeholder=None, title: str = "") -> str:
+    # Render tokens as they arrive so the user can start reading before the call finishes
+    if placeholder is None:
+        response = await client.ainvoke(messages)
+        return response.content
+
+    buffer = ""
+    async for chunk in client.astream(messages):
+        buffer += chunk.content
+        placeholder.markdown(f"**{title}**\n\n{buffer}")
+    return buffer
+
+async def cached_specialist_call(state: "MedicalState", namespace: str, messages: List[HumanMessage]) -> str:
+    # Namespaced per specialist so one role never answers for another
+    placeholder = state.get('stream_placeholders', {}).get(namespace)
+    cache = get_semantic_cache()
+    if cache is None:
+        return await stream_completion(messages, placeholder, namespace)
+
+    guard = tuple(str(state['prompt_vars'][field]) for field in CASE_GUARD_FIELDS)
+    cached = await cache.lookup(state['case_signature'], guard, namespace, get_embeddings())
+    if cached is not None:
+        if placeholder is not None:
+            placeholder.markdown(f"**{namespace}**\n\n{cached}")
+        return cached
+
+    content = await stream_completion(messages, placeholder, namespace)
+    await cache.store(state['case_signature'], guard, namespace, content, get_embeddings())
+    return content
+
 ### Qwen-VL API call ###
+VLM_MAX_EDGE = 1280
+
+def shrink_image(image: Image.Image, max_edge: int = VLM_MAX_EDGE) -> Image.Image:
+    width, height = image.size
+    scale = min(1.0, max_edge / max(width, height))
+    if scale == 1.0:
+        return image
+    return image.resize((int(width * scale), int(height * scale)), Image.LANCZOS)
+
+VLM_CACHE_MAX_ENTRIES = 128
+
+class LRUCache:
+    """Evicts its least recently used entry beyond max_entries; safe to share between sessions."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.items: OrderedDict[str, str] = OrderedDict()
+
+    def get(self, key: str) -> Optional[str]:
+        with self.lock:
+            value = self.items.get(key)
+            if value is not None:
+                self.items.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: str) -> None:
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            if len(self.items) > self.max_entries:
+                self.items.popitem(last=False)
+
+@st.cache_resource(show_spinner=False)
+def get_vlm_cache() -> LRUCache:
+    # Survives Streamlit reruns, which otherwise re-send the same uploads to the VLM
+    return LRUCache(VLM_CACHE_MAX_ENTRIES)
+
+class TransientVLMError(Exception):
+    """Raised for DashScope responses worth retrying (rate limits, server errors)."""
+
+@retry(
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(multiplier=0.5, max=4),
+    retry=retry_if_exception_type((TransientVLMError, requests.ConnectionError, requests.Timeout)),
+    reraise=True
+)
+async def request_vlm(messages: List[Dict]) -> str:
+    # Heavy optional SDK; only imported once an image actually needs analysis
+    import dashscope
+    dashscope.api_key = DASHSCOPE_API_KEY
+
+    # The DashScope SDK is blocking; run it in a thread so concurrent calls overlap
+    response = await asyncio.to_thread(
+        dashscope.MultiModalConversation.call,
+        model='qwen-vl-max-0809',
+        messages=messages
+    )
+
+    if response is not None and (response.status_code == 429 or response.status_code >= 500):
+        raise TransientVLMError(f"{response.status_code} - {response.message}")
+    if response and response.output and 'text' in response.output:
+        return response.output['text']
+    return ""
+
 async def call_vlm(image: Image.Image, prompt: str = "") -> str:
-    with tempfile.NamedTemporaryFile(suffix=".png") as tmp:
-        image.save(tmp.name, format="PNG")
-        with open(tmp.name, "rb") as f:
-            img_bytes = f.read()
+    upload = shrink_image(image)
+
+    # Encode in memory; JPEG keeps the upload far smaller than PNG for photos
+    buf = BytesIO()
+    if upload.mode != "RGB":
+        upload = upload.convert("RGB")
+    upload.save(buf, format="JPEG", quality=85)
+    img_bytes = buf.getvalue()
+    # Release the resized/converted copy now; the caller still owns the original
+    if upload is not image:
+        upload.close()
+
+    cache = get_vlm_cache()
+    key = hashlib.sha256(img_bytes + prompt.encode("utf-8")).hexdigest()
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+
     image_b64 = base64.b64encode(img_bytes).decode("utf-8")
 
     messages = [{
         'role': 'user',
         'content': [
             {
-                'image': f"data:image/png;base64,{image_b64}"
+                'image': f"data:image/jpeg;base64,{image_b64}"
             },
             {
                 'text': prompt
@@ -61,24 +287,34 @@ async def call_vlm(image: Image.Image, prompt: str = "") -> str:
         ]
     }]
 
-    response = dashscope.MultiModalConversation.call(
-        model='qwen-vl-max-0809',
-        messages=messages
-    )
+    # The payload is encoded once; request_vlm retries reuse it as-is
+    analysis = await request_vlm(messages)
+    if analysis:
+        cache.set(key, analysis)
+    return analysis
 
-    if response and response.output and 'text' in response.output:
-        return response.output['text']
-    return ""
-
-async def extract_pdf_summary(pdf_path: str) -> str:
-    if not pdf_path:
+async def extract_pdf_summary(pdf_bytes: bytes) -> str:
+    if not pdf_bytes:
         return ""
-        
-    images = convert_from_path(pdf_path)
-    if not images:
-        return "No images extracted from PDF."
 
-    first_page = images[0]
+    cache = get_vlm_cache()
+    key = "pdf:" + hashlib.sha256(pdf_bytes).hexdigest()
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+
+    import pymupdf
+
+    # Only the first page is summarized, so render just that one
+    doc = pymupdf.open(stream=pdf_bytes, filetype="pdf")
+    try:
+        if doc.page_count == 0:
+            return "No images extracted from PDF."
+        pix = doc.load_page(0).get_pixmap(dpi=150)
+        first_page = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+    finally:
+        doc.close()
+
     prompt = (
         "You are a medical data summarization assistant. Below is an image of a patient intake form. "
         "Provide a single sentence summary including the patient's name, age, gender, relevant medical history, "
@@ -86,26 +322,24 @@ async def extract_pdf_summary(pdf_path: str) -> str:
         "Do not guess any details not clearly visible. Do not assume family history."
     )
 
-    # Try full image
+    # Transient network/quota errors are retried inside request_vlm. Only an empty
+    # answer falls back to the top half of the page, where the identifying fields are.
     try:
         analysis = await call_vlm(first_page, prompt)
-        if analysis:
-            return analysis.strip()
-    except Exception:
-        pass
-
-    # If fails, try half image
-    width, height = first_page.size
-    half_box = (0, 0, width, height // 2)
-    top_half = first_page.crop(half_box)
-    try:
-        analysis = await call_vlm(top_half, prompt)
-        if analysis:
-            return analysis.strip()
-        else:
-            return "No analysis from Qwen-VL."
+        if not analysis:
+            width, height = first_page.size
+            with first_page.crop((0, 0, width, height // 2)) as top_half:
+                analysis = await call_vlm(top_half, prompt)
     except Exception as e:
         return f"Qwen-VL Error: {e}"
+    finally:
+        first_page.close()
+
+    if not analysis:
+        return "No analysis from Qwen-VL."
+    analysis = analysis.strip()
+    cache.set(key, analysis)
+    return analysis
 
 ### Data Structures ###
 @dataclass
@@ -115,10 +349,21 @@ class PatientInfo:
     current_symptoms: str
     images: Optional[List] = None  # Can hold URLs, file paths, or UploadedFile objects
 
+class FinalAssessment(BaseModel):
+    disease_name: str = Field(description="Primary diagnosis")
+    treatment_plan: str = Field(description="Specific treatment recommendations")
+    items_to_note: str = Field(description="Additional considerations")
+    medications: str = Field(description="Only the medications required, as a short bullet list")
+
+structured_client = client.with_structured_output(FinalAssessment, include_raw=True)
+
 class MedicalState(TypedDict):
     patient_info: PatientInfo
     complexity: str
     case_digest: str
+    case_prefix: str
+    case_signature: str
+    prompt_vars: Dict[str, str]
     current_diagnosis: str
     specialist_analyses: Dict[str, str]
     final_diagnosis: str
@@ -127,64 +372,42 @@ class MedicalState(TypedDict):
     human_feedback: str
     final_assessment: Dict[str, str]
     pharma_medication: str
-
-### Workflow Functions ###
-async def process_initial_data(state: MedicalState, pdf_path: str) -> MedicalState:
-    # Process Images
-    if state['patient_info'].images:
-        for img_obj in state['patient_info'].images:
-            # If this is an UploadedFile object:
-            if hasattr(img_obj, "getvalue"):
-                try:
-                    img = Image.open(BytesIO(img_obj.getvalue())).convert("RGB")
-                except Exception as e:
-                    st.error(f"Error processing uploaded image: {e}")
-                    continue
-            else:
-                # If it's a string, could be a URL or local file
-                try:
-                    if str(img_obj).startswith("http"):
-                        r = requests.get(img_obj)
-                        img = Image.open(BytesIO(r.content)).convert("RGB")
-                    else:
-                        img = Image.open(img_obj).convert("RGB")
-                except Exception as e:
-                    st.error(f"Error loading image from path: {img_obj}, error: {e}")
-                    continue
-
-            analysis = await call_vlm(img, "Describe any visible skin conditions or symptoms. Do not guess details not visible.")
-            if analysis:
-                state['current_diagnosis'] = analysis
-                state['patient_info'].basic_info['visual_findings'] = analysis
-
-    # Process PDF
-    pdf_summary = await extract_pdf_summary(pdf_path)
-    state['patient_info'].basic_info['record_summary'] = pdf_summary
-
-    # Create case digest
-    patient_name = state['patient_info'].basic_info.get('name', 'Unknown')
-    patient_age = state['patient_info'].basic_info.get('age', 'Unknown')
-    mh = state['patient_info'].medical_history.get('conditions', [])
-    mh_str = ', '.join(mh) if mh else 'None known'
-
-    state['case_digest'] = (
-        f"Patient {patient_name}, "
-        f"{patient_age} years old, "
-        f"presenting with {state['patient_info'].current_symptoms}. "
-        f"Medical history: {mh_str}. "
-        f"From intake form: {pdf_summary}"
-    )
-    state['patient_info'].basic_info['case_digest'] = state['case_digest']
-
-    return state
-
-async def general_dermatologist_analysis(state: MedicalState) -> MedicalState:
-    messages = [
-        HumanMessage(content=f"""
-        As a general dermatologist, analyze this case focusing on common skin conditions:
-        Patient Information: {state['case_digest']}
-        Current Symptoms: {state['patient_info'].current_symptoms}
-        Visual Analysis: {state.get('current_diagnosis', '')}
+    stream_placeholders: Dict[str, Any]
+
+### Prompt Templates ###
+CASE_DIGEST_TEMPLATE = (
+    "Patient {name}, "
+    "{age} years old, "
+    "presenting with {symptoms}. "
+    "Medical history: {conditions}. "
+    "From intake form: {record_summary}"
+)
+
+CASE_PREFIX_TEMPLATE = (
+    "Patient case:\n"
+    "{case_digest}\n"
+    "Gender: {gender}\n"
+    "Current Symptoms: {symptoms}\n"
+    "Medical History: {conditions}\n"
+    "Medications: {medications}\n"
+    "Allergies: {allergies}\n"
+    "Visual Analysis: {visual}\n\n"
+)
+
+CASE_SIGNATURE_TEMPLATE = (
+    "{symptoms}\n"
+    "Age: {age}\n"
+    "Gender: {gender}\n"
+    "Medical History: {conditions}\n"
+    "Medications: {medications}\n"
+    "Allergies: {allergies}\n"
+    "From intake form: {record_summary}\n"
+    "Visual Analysis: {visual}"
+)
+
+# Role instructions always follow the shared case prefix, so the prefix stays cacheable
+GENERAL_DERM_PROMPT = ChatPromptTemplate.from_template("""{case_prefix}
+        As a general dermatologist, analyze this case focusing on common skin conditions.
 
         Consider:
         1. Visible skin changes and patterns
@@ -193,197 +416,229 @@ async def general_dermatologist_analysis(state: MedicalState) -> MedicalState:
 
         Do not guess family history if not provided. Provide a detailed dermatological assessment.
         """)
-    ]
-    response = await client.ainvoke(messages)
-    state['specialist_analyses']['General_Dermatologist'] = response.content
-    return state
 
-async def endocrine_dermatologist_analysis(state: MedicalState) -> MedicalState:
-    messages = [
-        HumanMessage(content=f"""
+ENDOCRINE_DERM_PROMPT = ChatPromptTemplate.from_template("""{case_prefix}
         As a dermatologist specializing in endocrine-related skin conditions:
-        Patient Information: {state['case_digest']}
-        Current Symptoms: {state['patient_info'].current_symptoms}
-        Previous Analysis: {state['specialist_analyses'].get('General_Dermatologist', '')}
+        Previous Analysis: {general_analysis}
 
         Do not assume family history. Provide analysis focusing on endocrine-related aspects.
         """)
-    ]
-    response = await client.ainvoke(messages)
-    state['specialist_analyses']['Endocrine_Dermatologist'] = response.content
-    return state
 
-async def immune_dermatologist_analysis(state: MedicalState) -> MedicalState:
-    messages = [
-        HumanMessage(content=f"""
+IMMUNE_DERM_PROMPT = ChatPromptTemplate.from_template("""{case_prefix}
         As a dermatologist specializing in immune-related skin conditions:
-        Patient Information: {state['case_digest']}
-        Current Symptoms: {state['patient_info'].current_symptoms}
-        Previous Analyses:
-        General Assessment: {state['specialist_analyses'].get('General_Dermatologist', '')}
-        Endocrine Assessment: {state['specialist_analyses'].get('Endocrine_Dermatologist', '')}
+        Previous Analysis: {general_analysis}
 
         Do not guess family history. Focus on immune-related conditions.
         """)
-    ]
-    response = await client.ainvoke(messages)
-    state['specialist_analyses']['Immune_Dermatologist'] = response.content
-    return state
 
-async def determine_consultation_path(state: MedicalState) -> str:
-    messages = [
-        HumanMessage(content=f"""
-        You are a medical complexity assessment assistant. Based on the information given, determine the complexity of the case:
+CONSULTATION_PATH_PROMPT = ChatPromptTemplate.from_template("""{case_prefix}
+        You are a medical complexity assessment assistant. Based on the patient case above, determine the complexity of the case:
         - simple
         - moderate
         - complicated
 
-        Patient Information:
-        - Basic Info: {state['patient_info'].basic_info}
-        - Current Symptoms: {state['patient_info'].current_symptoms}
-        - Medical History: {state['patient_info'].medical_history}
-        - Initial Analysis: {state.get('current_diagnosis', '')}
-
         Do not guess family history. Return exactly one word: 'simple', 'moderate', or 'complicated'.
         """)
-    ]
-    response = await client.ainvoke(messages)
-    complexity = response.content.strip().lower()
-    return complexity
 
-async def synthesize_diagnosis(state: MedicalState) -> Dict:
-    all_analyses = "\n".join([f"{k}: {v}" for k, v in state['specialist_analyses'].items()])
-    if not all_analyses.strip():
-        return {
-            "disease_name": "Unknown",
-            "treatment_plan": "Unknown",
-            "items_to_note": "Unknown"
-        }
-
-    llm_prompt = f"""
-    You are a medical synthesis assistant. Based on the specialist analyses and patient info, generate a structured final diagnosis and treatment plan.
+FINAL_ASSESSMENT_PROMPT = ChatPromptTemplate.from_template("""{case_prefix}
+    You are a medical synthesis assistant and pharma agent. Based on the specialist analyses and patient info above, generate a structured final diagnosis and treatment plan.
     The output should include:
     Disease Name: [Primary Diagnosis]
     Treatment Plan: [Specific Treatment Recommendations]
     Items to Note: [Additional Considerations]
+    Medications: [Strictly only the medications required, in a short bullet list format]
 
     Do not guess family history if not provided.
     Specialist Analyses:
     {all_analyses}
+    """)
 
-    Patient Information:
-    - Name: {state['patient_info'].basic_info.get('name', 'Unknown')}
-    - Age: {state['patient_info'].basic_info.get('age', 'Unknown')}
-    - Gender: {state['patient_info'].basic_info.get('gender', 'Unknown')}
-    - Medical History: {', '.join(state['patient_info'].medical_history.get('conditions', []) or ['None known'])}
-    - Current Symptoms: {state['patient_info'].current_symptoms}
-    - Initial Analysis: {state.get('current_diagnosis', '')}
-    """
-    messages = [HumanMessage(content=llm_prompt)]
-    response = await client.ainvoke(messages)
+### Workflow Functions ###
+IMAGE_FETCH_TIMEOUT = 10
+
+def read_image_source(source) -> Image.Image:
+    if str(source).startswith("http"):
+        r = requests.get(source, timeout=IMAGE_FETCH_TIMEOUT)
+        r.raise_for_status()
+        return Image.open(BytesIO(r.content)).convert("RGB")
+    return Image.open(source).convert("RGB")
+
+async def load_patient_image(img_obj) -> Optional[Image.Image]:
+    # If this is an UploadedFile object:
+    if hasattr(img_obj, "getvalue"):
+        try:
+            return Image.open(BytesIO(img_obj.getvalue())).convert("RGB")
+        except Exception as e:
+            st.error(f"Error processing uploaded image: {e}")
+            return None
+
+    # If it's a string, could be a URL or local file. Download and decode together in a
+    # worker thread so neither blocks the event loop and several sources load at once.
+    try:
+        return await asyncio.to_thread(read_image_source, img_obj)
+    except Exception as e:
+        st.error(f"Error loading image from path: {img_obj}, error: {e}")
+        return None
+
+async def process_initial_data(state: MedicalState, pdf_bytes: bytes) -> MedicalState:
+    # Process Images
+    if state['patient_info'].images:
+        loaded = await asyncio.gather(*(load_patient_image(img_obj) for img_obj in state['patient_info'].images))
+        images = [img for img in loaded if img is not None]
+
+        # Analyze all images concurrently instead of one DashScope round-trip at a time
+        analyses = await asyncio.gather(
+            *(call_vlm(img, "Describe any visible skin conditions or symptoms. Do not guess details not visible.") for img in images),
+            return_exceptions=True
+        )
+        # Decoded uploads can be hundreds of MB each; drop them before the PDF is rendered
+        for img in images:
+            img.close()
+        del loaded, images
+        gc.collect()
+
+        findings = []
+        for analysis in analyses:
+            if isinstance(analysis, Exception):
+                st.error(f"Error analyzing image: {analysis}")
+            elif analysis:
+                findings.append(analysis)
+
+        if findings:
+            visual_findings = "\n\n".join(findings)
+            state['current_diagnosis'] = visual_findings
+            state['patient_info'].basic_info['visual_findings'] = visual_findings
+
+    # Process PDF
+    pdf_summary = await extract_pdf_summary(pdf_bytes)
+    state['patient_info'].basic_info['record_summary'] = pdf_summary
 
-    lines = [l.strip() for l in response.content.strip().split("\n") if l.strip()]
-    disease_name = "Unknown"
-    treatment_plan = "Unknown" 
-    items_to_note = "Unknown"
-    for line in lines:
-        if line.lower().startswith("disease name:"):
-            disease_name = line.split(":", 1)[1].strip()
-        elif line.lower().startswith("treatment plan:"):
-            treatment_plan = line.split(":", 1)[1].strip()
-        elif line.lower().startswith("items to note:"):
-            items_to_note = line.split(":", 1)[1].strip()
-
-    return {
-        "disease_name": disease_name,
-        "treatment_plan": treatment_plan,
-        "items_to_note": items_to_note
+    # Resolve every patient field once; all prompts below format from these values
+    basic_info = state['patient_info'].basic_info
+    medical_history = state['patient_info'].medical_history
+    state['prompt_vars'] = prompt_vars = {
+        "name": basic_info.get('name', 'Unknown'),
+        "age": basic_info.get('age', 'Unknown'),
+        "gender": basic_info.get('gender', 'Unknown'),
+        "conditions": ', '.join(medical_history.get('conditions', [])) or 'None known',
+        "medications": ', '.join(medical_history.get('medications', [])) or 'None known',
+        "allergies": ', '.join(medical_history.get('allergies', [])) or 'None known',
+        "symptoms": state['patient_info'].current_symptoms,
+        "visual": state.get('current_diagnosis', ''),
+        "record_summary": pdf_summary,
     }
 
-async def pharmaagent_analysis(state: MedicalState) -> MedicalState:
-    # Use the final_assessment, patient info, and specialist analyses to get medications
-    final_assessment = state["final_assessment"]
-    all_analyses = "\n".join([f"{k}: {v}" for k,v in state['specialist_analyses'].items()])
+    state['case_digest'] = CASE_DIGEST_TEMPLATE.format(**prompt_vars)
+    basic_info['case_digest'] = state['case_digest']
 
-    llm_prompt = f"""
-    You are a pharma agent. Given the following information, return strictly only the medications required:
+    # Shared, unchanging lead-in for every downstream prompt. Keeping it as the exact
+    # first tokens lets Azure OpenAI's prompt prefix cache hit on the later calls.
+    state['case_prefix'] = CASE_PREFIX_TEMPLATE.format(case_digest=state['case_digest'], **prompt_vars)
+    # Every prompt field except the name, so cases differing in e.g. allergies never share a key
+    state['case_signature'] = CASE_SIGNATURE_TEMPLATE.format(**prompt_vars)
 
-    Patient Information:
-    - Name: {state['patient_info'].basic_info.get('name', 'Unknown')}
-    - Age: {state['patient_info'].basic_info.get('age', 'Unknown')}
-    - Gender: {state['patient_info'].basic_info.get('gender', 'Unknown')}
-    - Medical History: {', '.join(state['patient_info'].medical_history.get('conditions', []) or ['None known'])}
-    - Current Symptoms: {state['patient_info'].current_symptoms}
+    return state
 
-    Specialist Analyses:
-    {all_analyses}
+async def general_dermatologist_analysis(state: MedicalState) -> MedicalState:
+    messages = GENERAL_DERM_PROMPT.format_messages(case_prefix=state['case_prefix'])
+    state['specialist_analyses']['General_Dermatologist'] = await cached_specialist_call(state, "General_Dermatologist", messages)
+    return state
 
-    Final Assessment:
-    Disease Name: {final_assessment['disease_name']}
-    Treatment Plan: {final_assessment['treatment_plan']}
-    Items to Note: {final_assessment['items_to_note']}
+async def endocrine_dermatologist_analysis(state: MedicalState) -> MedicalState:
+    messages = ENDOCRINE_DERM_PROMPT.format_messages(
+        case_prefix=state['case_prefix'],
+        general_analysis=state['specialist_analyses'].get('General_Dermatologist', '')
+    )
+    state['specialist_analyses']['Endocrine_Dermatologist'] = await cached_specialist_call(state, "Endocrine_Dermatologist", messages)
+    return state
 
-    Return strictly only the medication required, in a short bullet list format.
-    """
-    messages = [HumanMessage(content=llm_prompt)]
-    response = await client.ainvoke(messages)
-    # Assume response is medication list
-    state["pharma_medication"] = response.content.strip()
+async def immune_dermatologist_analysis(state: MedicalState) -> MedicalState:
+    messages = IMMUNE_DERM_PROMPT.format_messages(
+        case_prefix=state['case_prefix'],
+        general_analysis=state['specialist_analyses'].get('General_Dermatologist', '')
+    )
+    state['specialist_analyses']['Immune_Dermatologist'] = await cached_specialist_call(state, "Immune_Dermatologist", messages)
     return state
 
+async def determine_consultation_path(state: MedicalState) -> str:
+    messages = CONSULTATION_PATH_PROMPT.format_messages(case_prefix=state['case_prefix'])
+    response = await client.ainvoke(messages)
+    complexity = response.content.strip().lower()
+    return complexity
+
+async def synthesize_diagnosis(state: MedicalState) -> Dict:
+    all_analyses = "\n".join([f"{k}: {v}" for k, v in state['specialist_analyses'].items()])
+    if not all_analyses.strip():
+        return {
+            "disease_name": "Unknown",
+            "treatment_plan": "Unknown",
+            "items_to_note": "Unknown",
+            "medications": ""
+        }
+
+    # Diagnosis and medications come back from one structured call instead of a
+    # synthesis call followed by a separate pharma call over the same context
+    messages = FINAL_ASSESSMENT_PROMPT.format_messages(case_prefix=state['case_prefix'], all_analyses=all_analyses)
+    result = await structured_client.ainvoke(messages)
+    if result["parsed"] is None:
+        # Keep the same fallback the old text parser used rather than failing the consultation
+        return {
+            "disease_name": "Unknown",
+            "treatment_plan": "Unknown",
+            "items_to_note": "Unknown",
+            "medications": ""
+        }
+    return result["parsed"].model_dump()
+
 async def final_assessment_node(state: MedicalState) -> MedicalState:
     final_assessment = await synthesize_diagnosis(state)
+    state["pharma_medication"] = final_assessment.pop("medications").strip()
     state["final_assessment"] = final_assessment
     return state
 
-async def create_dermatology_workflow() -> StateGraph:
+# Follow-up specialists issued together, in one burst, for each consultation path
+SPECIALISTS_BY_PATH = {
+    "simple": (),
+    "moderate": (endocrine_dermatologist_analysis,),
+    "complicated": (endocrine_dermatologist_analysis, immune_dermatologist_analysis),
+}
+
+async def parallel_specialist_analysis(state: MedicalState) -> MedicalState:
+    # Endocrine and immune only build on the general assessment, so they can run concurrently
+    if 'General_Dermatologist' not in state['specialist_analyses']:
+        state = await general_dermatologist_analysis(state)
+
+    specialists = SPECIALISTS_BY_PATH.get(state.get("consultation_path", "simple"), ())
+
+    # Each specialist writes its own key into state['specialist_analyses']
+    await asyncio.gather(*(specialist(state) for specialist in specialists))
+    return state
+
+def create_dermatology_workflow():
+    from langgraph.graph import StateGraph, END
+
     workflow = StateGraph(MedicalState)
-    workflow.add_node("general_derm", general_dermatologist_analysis)
-    workflow.add_node("endocrine_derm", endocrine_dermatologist_analysis)
-    workflow.add_node("immune_derm", immune_dermatologist_analysis)
+    workflow.add_node("specialists_parallel", parallel_specialist_analysis)
     workflow.add_node("final_assessment_node", final_assessment_node)
-    workflow.add_node("pharmaagent", pharmaagent_analysis)
-    workflow.add_node("end", lambda x: x)
-
-    workflow.set_entry_point("general_derm")
-
-    def route_by_complexity(state: MedicalState) -> str:
-        return state.get("consultation_path", "simple")
-
-    # After general derm
-    workflow.add_conditional_edges(
-        "general_derm",
-        route_by_complexity,
-        {
-            "simple": "final_assessment_node",
-            "moderate": "endocrine_derm",
-            "complicated": "endocrine_derm"
-        }
-    )
 
-    # After endocrine derm
-    workflow.add_conditional_edges(
-        "endocrine_derm",
-        route_by_complexity,
-        {
-            "simple": "final_assessment_node",
-            "moderate": "final_assessment_node",
-            "complicated": "immune_derm"
-        }
-    )
+    workflow.set_entry_point("specialists_parallel")
 
-    # After immune derm always go to final_assessment_node
-    workflow.add_edge("immune_derm", "final_assessment_node")
+    # After the specialists always go to final_assessment_node
+    workflow.add_edge("specialists_parallel", "final_assessment_node")
 
-    # After final_assessment_node always go to pharmaagent
-    workflow.add_edge("final_assessment_node", "pharmaagent")
+    # After final_assessment_node go to end
+    workflow.add_edge("final_assessment_node", END)
 
-    # After pharmaagent go to end
-    workflow.add_edge("pharmaagent", "end")
-
-    workflow.set_finish_point("end")
     return workflow.compile()
 
+def get_dermatology_workflow():
+    # Compiled once per session rather than per run. Not per process: the nodes call the
+    # module-level clients of the run that compiled them, which belong to that session's
+    # event loop and connection pool.
+    if "dermatology_workflow" not in st.session_state:
+        st.session_state.dermatology_workflow = create_dermatology_workflow()
+    return st.session_state.dermatology_workflow
+
 def run():
     st.set_page_config(layout="wide")
     st.title("Dermatology Consultation Assistant")
@@ -402,11 +657,9 @@ def run():
 
         st.header("Patient Records")
         uploaded_pdf = st.file_uploader("Upload Patient Intake PDF (Optional)", type=["pdf"])
-        pdf_path = ""
+        pdf_bytes = b""
         if uploaded_pdf:
-            with open("temp_uploaded.pdf", "wb") as f:
-                f.write(uploaded_pdf.read())
-            pdf_path = "temp_uploaded.pdf"
+            pdf_bytes = uploaded_pdf.getvalue()
             st.success("PDF uploaded successfully!")
 
         # Handle image upload with checks
@@ -461,11 +714,14 @@ def run():
 
     if run_button:
         async def run_consultation():
-            workflow = await create_dermatology_workflow()
+            workflow = get_dermatology_workflow()
             initial_state = MedicalState(
                 patient_info=patient_info,
                 complexity="",
                 case_digest="",
+                case_prefix="",
+                case_signature="",
+                prompt_vars={},
                 current_diagnosis="",
                 specialist_analyses={},
                 final_diagnosis="",
@@ -473,15 +729,25 @@ def run():
                 consultation_path="general",
                 human_feedback=human_feedback,
                 final_assessment={},
-                pharma_medication=""
+                pharma_medication="",
+                stream_placeholders={}
             )
 
             with st.spinner("Processing initial data..."):
-                state = await process_initial_data(initial_state, pdf_path)
+                state = await process_initial_data(initial_state, pdf_bytes)
 
             complexity_placeholder = st.empty()
+            # Specialist analyses stream into these while the workflow runs
+            state["stream_placeholders"] = {
+                specialist: st.empty()
+                for specialist in ("General_Dermatologist", "Endocrine_Dermatologist", "Immune_Dermatologist")
+            }
             with st.spinner("Deciding complexity..."):
-                consultation_path = await determine_consultation_path(state)
+                # The general assessment only reads the initial state, so overlap it with triage
+                consultation_path, state = await asyncio.gather(
+                    determine_consultation_path(state),
+                    general_dermatologist_analysis(state)
+                )
             state["consultation_path"] = consultation_path
             complexity_placeholder.write(f"**Case complexity determined:** {consultation_path}")
 
@@ -492,6 +758,8 @@ def run():
 
             with st.spinner("Consulting specialists and finalizing..."):
                 final_state = await workflow.ainvoke(state)
+            for placeholder in state["stream_placeholders"].values():
+                placeholder.empty()
 
             final_assessment = final_state["final_assessment"]
             st.session_state["final_assessment"] = final_assessment
@@ -525,7 +793,15 @@ def run():
                 mime="text/plain"
             )
 
-        asyncio.run(run_consultation())
+        loop = get_event_loop()
+        try:
+            loop.run_until_complete(run_consultation())
+        finally:
+            # Don't let tasks left over from a failed gather resume on the next run
+            leftover = asyncio.all_tasks(loop)
+            for task in leftover:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*leftover, return_exceptions=True))
 
     # Show button to copy details for pharma shop after consultation is done
     if st.session_state["final_assessment"] is not None and not st.session_state["show_pharma_details"]:
@@ -1,24 +1,46 @@
 # app.py
 import streamlit as st
 import json
+import re
 from typing import TypedDict, Dict, List, Optional, Tuple
 from dataclasses import dataclass
 import os
+import logging
+import importlib.util
+import httpx
+import tiktoken
 from dotenv import load_dotenv
 from langchain_core.messages import HumanMessage, SystemMessage, AIMessage
 from langchain_openai import AzureChatOpenAI
 
+logger = logging.getLogger(__name__)
+
+# Semantic response cache backed by the retrieval Chroma store; optional outside the backend env
+try:
+    from derma_bot.retrival.cache import embed_messages, lookup, store
+    SEMANTIC_CACHE_ENABLED = True
+except ImportError:
+    SEMANTIC_CACHE_ENABLED = False
+
+# Embedding match for lay diagnoses ("pimples" -> "acne") when no condition name appears verbatim
+try:
+    from derma_bot.retrival.conditions import match_condition
+    SEMANTIC_MATCH_ENABLED = True
+except ImportError:
+    SEMANTIC_MATCH_ENABLED = False
+
 # Initialize session state
-if 'messages' not in st.session_state:
-    st.session_state.messages = []
-if 'current_agent' not in st.session_state:
-    st.session_state.current_agent = None
-if 'attempts' not in st.session_state:
-    st.session_state.attempts = 0
-if 'patient_sold' not in st.session_state:
-    st.session_state.patient_sold = False
-if 'conversation_history' not in st.session_state:
-    st.session_state.conversation_history = []
+def session_defaults() -> Dict:
+    return {
+        "messages": [],
+        "current_agent": None,
+        "attempts": 0,
+        "patient_sold": False,
+        "conversation_history": [],
+    }
+
+for key, value in session_defaults().items():
+    st.session_state.setdefault(key, value)
 
 # Define available medicines and conditions
 AVAILABLE_MEDICINES = {
@@ -31,108 +53,190 @@ AVAILABLE_MEDICINES = {
     "psoriasis": ["psoriasis treatment"]
 }
 
-def initialize_azure_client():
+# One compiled alternation scans a diagnosis for every supported condition in a single pass
+CONDITION_RE = re.compile("|".join(re.escape(condition) for condition in AVAILABLE_MEDICINES))
+
+# Brand agents in priority order, with the diagnosis keywords that select each one
+AGENT_CATALOG = [
+    (("alopecia", "hair"), ("monoxodil", "SIPHLA", "Monoxodil")),
+    (("acne",), ("acne", "CERA", "AcneControl Cream")),
+    (("roscea", "rosacea"), ("roscea", "NIVEA", "RosceaRelief Lotion")),
+    (("mole",), ("mole", "HAILUOUS", "MoleFade Serum")),
+    (("rash",), ("rashes", "DOVE", "RashGuard Ointment")),
+]
+AGENT_KEYWORD_PRIORITY = {keyword: priority for priority, (keywords, _) in enumerate(AGENT_CATALOG) for keyword in keywords}
+AGENT_KEYWORD_RE = re.compile("|".join(re.escape(keyword) for keyword in AGENT_KEYWORD_PRIORITY))
+
+@st.cache_resource(show_spinner=False)
+def get_http_client() -> httpx.Client:
+    # One keep-alive pool shared by every sales turn and every session in this process.
+    # HTTP/2 needs the optional h2 package (httpx[http2]).
+    return httpx.Client(
+        http2=importlib.util.find_spec("h2") is not None,
+        limits=httpx.Limits(max_connections=20, max_keepalive_connections=20),
+        timeout=60.0
+    )
+
+# Built once per process so .env parsing and the client's connection pool survive reruns.
+# Failures raise rather than return None: st.cache_resource does not cache exceptions, so
+# the next rerun retries instead of reusing a broken client.
+@st.cache_resource(show_spinner=False)
+def initialize_azure_client(deployment_name="gpt-4o", temperature=0.7):
     load_dotenv()
     required_vars = ["AZURE_OAI_API_KEY", "AZURE_OPENAI_ENDPOINT"]
     
     missing_vars = [var for var in required_vars if not os.getenv(var)]
     if missing_vars:
-        st.error(f"Missing required environment variables: {', '.join(missing_vars)}")
-        return None
+        raise ValueError(f"Missing required environment variables: {', '.join(missing_vars)}")
 
-    try:
-        return AzureChatOpenAI(
-            api_key=os.getenv("AZURE_OAI_API_KEY"),
-            azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-            deployment_name="gpt-4o",
-            api_version="2024-02-15-preview",
-            temperature=0.7
-        )
-    except Exception as e:
-        st.error(f"Failed to initialize Azure OpenAI client: {str(e)}")
-        return None
+    return AzureChatOpenAI(
+        api_key=os.getenv("AZURE_OAI_API_KEY"),
+        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+        deployment_name=deployment_name,
+        api_version="2024-02-15-preview",
+        temperature=temperature,
+        streaming=True,
+        stream_usage=True,
+        http_client=get_http_client()
+    )
+
+# Persuasion replies use gpt-4o; the templated product intro goes to the smaller model
+try:
+    client = initialize_azure_client()
+    client_light = initialize_azure_client("gpt-4o-mini", temperature=0.3)
+except Exception as e:
+    st.error(f"Failed to initialize Azure OpenAI client: {str(e)}")
+    st.stop()
 
-client = initialize_azure_client()
+def resolve_condition(diagnosis: str) -> Optional[str]:
+    """Return the supported condition a diagnosis refers to, if any"""
+    diagnosis = diagnosis.lower()
+    match = CONDITION_RE.search(diagnosis)
+    if match:
+        return match.group(0)
+    if SEMANTIC_MATCH_ENABLED and diagnosis.strip():
+        return match_condition(diagnosis)
+    return None
 
 def check_medicine_availability(diagnosis: str, medicines: str) -> Tuple[bool, str]:
     """Check if we have appropriate medicines for the condition"""
-    diagnosis = diagnosis.lower()
-    medicines = medicines.lower()
-    
     # Check if any of our supported conditions are mentioned in diagnosis
-    available_condition = False
-    for condition in AVAILABLE_MEDICINES.keys():
-        if condition in diagnosis:
-            available_condition = True
-            break
-            
-    if not available_condition:
+    if resolve_condition(diagnosis) is None:
         return False, "We don't have specific treatments for this condition."
     
     return True, "Medicine available"
 
+# Purchase confirmation is decided locally; the affirmative phrase match was always required anyway
+AFFIRM_RE = re.compile(
+    r"\b(yes|yeah|yep|i agree|i(?:'|’)?ll (?:buy|purchase|take it)|i will (?:buy|purchase|take it)"
+    r"|i(?:'|’)?m in|i am in|sounds good|let(?:'|’)?s do it)\b",
+    re.IGNORECASE
+)
+NEG_RE = re.compile(r"\b(no|not|don(?:'|’)?t|won(?:'|’)?t|maybe|later)\b", re.IGNORECASE)
+
 def checker_agent(last_agent_message: str, last_patient_message: str) -> bool:
-    checker_messages = [
-        SystemMessage(content=(
-            "You are a CheckerAgent. Determine if the patient has explicitly agreed to purchase.\n\n"
-            "**Criteria for SOLD:**\n"
-            "- Patient explicitly says 'yes', 'yes I will buy', 'I agree', 'I will purchase', or similar.\n\n"
-            "**NOT SOLD:**\n"
-            "- Questions like 'Is this good?' are not confirmations.\n\n"
-            "Respond ONLY 'SOLD' or 'NOT SOLD'."
-        )),
-        HumanMessage(content=(
-            f"Agent said: {last_agent_message}\n"
-            f"Patient said: {last_patient_message}\n"
-            "Has the patient agreed to purchase?"
-        ))
-    ]
-
-    checker_response = client.invoke(checker_messages)
-    result = checker_response.content.strip().upper()
-
-    affirmative_keywords = ["yes", "i will buy", "i agree", "i'll purchase", "i will purchase", "i am in"]
-    return result == "SOLD" and any(kw in last_patient_message.lower() for kw in affirmative_keywords)
+    """Determine if the patient has explicitly agreed to purchase"""
+    return bool(AFFIRM_RE.search(last_patient_message)) and not NEG_RE.search(last_patient_message)
 
 def get_agent_info(diagnosis: str):
-    diagnosis = diagnosis.lower()
-    if "alopecia" in diagnosis or "hair" in diagnosis or "hair loss" in diagnosis:
-        return "monoxodil", "SIPHLA", "Monoxodil"
-    elif "acne" in diagnosis:
-        return "acne", "CERA", "AcneControl Cream"
-    elif "roscea" in diagnosis or "rosacea" in diagnosis:
-        return "roscea", "NIVEA", "RosceaRelief Lotion"
-    elif "mole" in diagnosis:
-        return "mole", "HAILUOUS", "MoleFade Serum"
-    elif "rash" in diagnosis or "rashes" in diagnosis:
-        return "rashes", "DOVE", "RashGuard Ointment"
-    return None, None, None
+    matched = {AGENT_KEYWORD_PRIORITY[keyword] for keyword in AGENT_KEYWORD_RE.findall(diagnosis.lower())}
+    if not matched:
+        return None, None, None
+    # Earlier catalog entries win when a diagnosis mentions several conditions
+    return AGENT_CATALOG[min(matched)][1]
+
+# Conversation roles mapped onto st.chat_message avatars
+CHAT_ROLES = {"Agent": "assistant", "Patient": "user"}
+
+def stream_agent_message(messages, ns: str, llm=None, cacheable: bool = True) -> str:
+    """Render the agent's reply token by token as it arrives and return the full text"""
+    placeholder = st.chat_message(CHAT_ROLES["Agent"]).empty()
+    use_cache = SEMANTIC_CACHE_ENABLED and cacheable
+
+    embedding = None
+    if use_cache:
+        embedding = embed_messages(messages)
+        cached = lookup(messages, ns, embedding=embedding)
+        if cached is not None:
+            placeholder.markdown(cached)
+            return cached
+
+    buf = ""
+    usage = None
+    for chunk in (llm or client).stream(messages):
+        buf += chunk.content
+        usage = chunk.usage_metadata or usage
+        placeholder.markdown(buf)
+
+    # Verify Azure prompt-prefix cache hits; the usage arrives on the final chunk
+    if usage:
+        cached_tokens = usage.get("input_token_details", {}).get("cache_read", 0)
+        logger.info(f"[{ns}] prompt tokens: {usage.get('input_tokens')}, cached: {cached_tokens}")
+
+    if use_cache:
+        store(messages, ns, buf.strip(), embedding=embedding)
+    return buf.strip()
+
+# Identical for every agent and every turn, so it leads the system prompt. At ~150 tokens it
+# is below Azure's 1024-token prompt-cache minimum on its own; hits start once the system
+# prompt plus replayed history pass that size, since each turn extends the previous request
+STATIC_AGENT_PROMPT = (
+    "You are a sales agent in the Pharma AI Shop, speaking with a patient after their doctor's consultation.\n"
+    "Shop catalog (condition: products):\n"
+    + "".join(f"- {condition}: {', '.join(products)}\n" for condition, products in AVAILABLE_MEDICINES.items())
+    + "Rules:\n"
+    "- Only focus on your product and brand.\n"
+    "- If patient hasn't agreed, keep persuading them to say YES.\n"
+    "- Never go off-topic.\n"
+)
 
 def build_agent_system_prompt(agent_name: str, brand: str, product: str) -> str:
-    return (
-        f"You are the {agent_name.capitalize()}Agent by {brand}. Your goal is to get the patient to say 'YES' to using {product}.\n"
-        "Rules:\n"
-        "- Only focus on your product and brand.\n"
-        "- If patient hasn't agreed, keep persuading them to say YES.\n"
-        f"- If patient says YES, respond: 'Thank you for choosing {product} by {brand}. Have a great day!'\n"
-        "- Never go off-topic."
+    return STATIC_AGENT_PROMPT + (
+        f"You are the {agent_name.capitalize()}Agent by {brand}. Your goal is to get the patient to say 'YES' to using {product}. "
+        f"If the patient says YES, respond: 'Thank you for choosing {product} by {brand}. Have a great day!'"
     )
 
+# Token budget for the replayed conversation; the system prompt is always sent in full
+HISTORY_TOKEN_BUDGET = 2000
+
+@st.cache_resource(show_spinner=False)
+def get_token_encoder():
+    # tiktoken ships with langchain-openai; the BPE file is loaded once per process
+    return tiktoken.encoding_for_model("gpt-4o")
+
+def trim_history(history: List[Dict[str, str]], budget: int = HISTORY_TOKEN_BUDGET) -> List[Dict[str, str]]:
+    """Keep the newest messages that fit in the token budget, in their original order.
+    The latest message is always kept, even on its own over budget."""
+    if not history:
+        return []
+    enc = get_token_encoder()
+    total = len(enc.encode(history[-1]["content"]))
+    start = len(history) - 1
+    while start > 0:
+        total += len(enc.encode(history[start - 1]["content"]))
+        if total > budget:
+            break
+        start -= 1
+    return history[start:]
+
 def generate_agent_response(agent_name: str, conversation_history: List[Dict[str, str]]) -> str:
     """Generate next agent response based on conversation history"""
     agent_name, brand, product = get_agent_info(agent_name)
     system_prompt = build_agent_system_prompt(agent_name, brand, product)
     
+    # The system prompt stays pinned first. A normal consultation fits the budget whole, so
+    # each request extends the previous one; only oversized histories drop their oldest turns
     messages = [SystemMessage(content=system_prompt)]
-    for msg in conversation_history[-6:]:
+    for msg in trim_history(conversation_history):
         if msg["role"] == "Patient":
             messages.append(HumanMessage(content=msg["content"]))
         else:
             messages.append(AIMessage(content=msg["content"]))
     
     try:
-        response = client.invoke(messages)
-        return response.content.strip()
+        # Not cached: the embedding model truncates long conversations, so the patient's
+        # latest turn would barely affect the cache key
+        return stream_agent_message(messages, "sales_reply", cacheable=False)
     except Exception as e:
         st.error(f"Error generating response: {str(e)}")
         return "I apologize, but I'm having trouble generating a response at the moment."
@@ -142,11 +246,7 @@ def main():
     
     # Initialize or reset consultation
     if st.sidebar.button("New Consultation"):
-        st.session_state.messages = []
-        st.session_state.current_agent = None
-        st.session_state.attempts = 0
-        st.session_state.patient_sold = False
-        st.session_state.conversation_history = []
+        st.session_state.update(session_defaults())
 
     # Display current attempt count
     if st.session_state.attempts > 0:
@@ -166,6 +266,9 @@ def main():
                     return
                 
                 agent_info = get_agent_info(diagnosis)
+                if agent_info[0] is None:
+                    # Fall back to the canonical condition for lay wording like "pimples"
+                    agent_info = get_agent_info(resolve_condition(diagnosis) or "")
                 if agent_info[0] is None:
                     st.error("You can buy medicines on other pharmacy stores!")
                     return
@@ -178,18 +281,14 @@ def main():
                     SystemMessage(content="You are a professional PharmaAgent."),
                     HumanMessage(content=f"Doctor's Diagnosis: {diagnosis}\nMedicines Given: {medicines}\n\nIntroduce {product} by {brand} for their condition.")
                 ]
-                intro = client.invoke(intro_messages).content
+                # Namespaced per product so a similar diagnosis never gets another product's intro
+                intro = stream_agent_message(intro_messages, f"sales_intro:{brand}:{product}", client_light)
                 st.session_state.conversation_history.append({"role": "Agent", "content": intro})
                 st.rerun()
 
-    # Display conversation history with dark theme
+    # Display conversation history
     for message in st.session_state.conversation_history:
-        role_style = "background-color: #2b2b2b" if message["role"] == "Agent" else "background-color: #1a1a1a"
-        st.markdown(f"""
-        <div style='{role_style}; padding: 10px; border-radius: 5px; margin: 5px; color: white;'>
-            <b>{message["role"]}:</b> {message["content"]}
-        </div>
-        """, unsafe_allow_html=True)
+        st.chat_message(CHAT_ROLES[message["role"]]).markdown(message["content"])
 
     # Input for patient response - Maximum 5 attempts
     if st.session_state.current_agent and not st.session_state.patient_sold and st.session_state.attempts < 5:
@@ -197,6 +296,7 @@ def main():
         if patient_message:
             # Add patient message to history
             st.session_state.conversation_history.append({"role": "Patient", "content": patient_message})
+            st.chat_message(CHAT_ROLES["Patient"]).markdown(patient_message)
             
             # Generate agent response
             agent_response = generate_agent_response(
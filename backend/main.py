@@ -1,21 +1,75 @@
 import os 
-from typing import Annotated, TypedDict, List, Dict
-from langgraph.graph import StateGraph, Graph, END, START
-from langgraph.prebuilt import ToolNode
-from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
+import json
+import re
+import uuid
+import time
+import asyncio
+import importlib.util
+import httpx
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from typing import Annotated, List, Dict
+from langgraph.graph import StateGraph, END, START
+from langgraph.constants import TAG_NOSTREAM
+from langgraph.graph.message import add_messages
+from langchain_core.messages import HumanMessage, AIMessage, AIMessageChunk
+from langchain_core.prompts import ChatPromptTemplate
 from langchain_openai import AzureChatOpenAI
-import operator
-from dataclasses import dataclass
-from termcolor import cprint
+from langchain_core.caches import InMemoryCache
+from langchain_core.globals import set_llm_cache
+from pydantic import BaseModel, Field
+from dataclasses import dataclass, field
 from dotenv import load_dotenv
-from fastapi import Body, FastAPI, Request
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 
 # Load environment variables
 load_dotenv()
 
-app = FastAPI()
+# Exact-match LLM response cache; repeated prompts are answered without an API call.
+# Set LLM_CACHE_PATH to persist it in SQLite across restarts (this writes patient text to disk).
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH")
+if LLM_CACHE_PATH:
+    from langchain_community.cache import SQLiteCache
+    set_llm_cache(SQLiteCache(database_path=LLM_CACHE_PATH))
+else:
+    set_llm_cache(InMemoryCache())
+
+# Set CHECKPOINT_DB_PATH to checkpoint each graph step in SQLite, so a consultation that
+# fails midway resumes from its last completed node (this writes patient text to disk)
+CHECKPOINT_DB_PATH = os.getenv("CHECKPOINT_DB_PATH")
+checkpointer = None
+
+async def get_checkpointer():
+    global checkpointer
+    if checkpointer is None and CHECKPOINT_DB_PATH:
+        import aiosqlite
+        from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+        checkpointer = AsyncSqliteSaver(await aiosqlite.connect(CHECKPOINT_DB_PATH))
+    return checkpointer
+
+# Semantic response cache backed by the retrieval Chroma store, so paraphrased intakes can
+# reuse a specialist opinion; optional when the retrieval package is not installed
+try:
+    from derma_bot.retrival.cache import embed_messages, lookup, store
+    SEMANTIC_CACHE_ENABLED = True
+except ImportError:
+    SEMANTIC_CACHE_ENABLED = False
+
+# Loading the embedding model and opening Chroma takes seconds; do it in the background at
+# startup, while the server waits for its first patient, instead of inside that consultation
+warmup_tasks = set()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if SEMANTIC_CACHE_ENABLED:
+        task = asyncio.create_task(asyncio.to_thread(embed_messages, [HumanMessage(content="warmup")]))
+        warmup_tasks.add(task)
+        task.add_done_callback(warmup_tasks.discard)
+    yield
+
+app = FastAPI(lifespan=lifespan)
 
 # Allow CORS for frontend
 origins = [
@@ -30,118 +84,266 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Define state schema
-class DermatologyState(TypedDict):
+def pending_consult() -> dict:
+    return {"status": "pending"}
+
+# Define state schema; a slotted dataclass gives nodes attribute access without per-instance dicts
+@dataclass(slots=True)
+class DermatologyState:
     """Graph state definition"""
-    messages: Annotated[list, operator.add]  # chat history
-    patient_info: dict  # patient info
-    skin_condition: str  # skin condition
-    difficulty_level: str  # Basic, Intermediate, or Advanced
-    medical_dermatologist_consult: dict  # medical dermatologist view
-    surgical_dermatologist_consult: dict  # surgical dermatologist view
-    dermatopathologist_consult: dict  # dermatopathologist view
-    diagnosis: str  # diagnosis result
-    treatment_plan: str  # treatment plan
-    prescription: str  # prescription
-
-def determine_difficulty(state: DermatologyState, llm) -> str:
+    messages: Annotated[list, add_messages] = field(default_factory=list)  # chat history
+    patient_info: dict = field(default_factory=dict)  # patient info
+    skin_condition: str = ""  # skin condition
+    context_block: str = ""  # case context shared by every specialist prompt
+    difficulty_level: str = ""  # Basic, Intermediate, or Advanced
+    medical_dermatologist_consult: dict = field(default_factory=pending_consult)  # medical dermatologist view
+    surgical_dermatologist_consult: dict = field(default_factory=pending_consult)  # surgical dermatologist view
+    dermatopathologist_consult: dict = field(default_factory=pending_consult)  # dermatopathologist view
+    diagnosis: str = ""  # diagnosis result
+    treatment_plan: str = ""  # treatment plan
+    prescription: str = ""  # prescription
+
+# Structured pharmacist output; the schema replaces free-text headings
+class Medication(BaseModel):
+    name: str = Field(description="Medication name")
+    dosage: str = Field(description="Strength and dose")
+    instructions: str = Field(description="How and when to use it, and for how long")
+
+class Prescription(BaseModel):
+    medications: List[Medication] = Field(description="Comprehensive medication plan")
+    interactions: List[str] = Field(description="Potential drug interactions")
+    side_effects: List[str] = Field(description="Side effects to monitor")
+    precautions: List[str] = Field(description="Important precautions")
+    lifestyle: List[str] = Field(description="Lifestyle recommendations")
+
+def format_prescription(prescription: Prescription) -> str:
+    """Render a structured prescription as the text shown on the pharmacist card"""
+    lines = ["Medications:"]
+    lines += [f"- {med.name} ({med.dosage}): {med.instructions}" for med in prescription.medications]
+    for title, items in (
+        ("Drug interactions", prescription.interactions),
+        ("Side effects to monitor", prescription.side_effects),
+        ("Precautions", prescription.precautions),
+        ("Lifestyle", prescription.lifestyle),
+    ):
+        if items:
+            lines += ["", f"{title}:"] + [f"- {item}" for item in items]
+    return "\n".join(lines)
+
+# System prompts are module constants so every request starts with a byte-identical prefix,
+# which Azure OpenAI can serve from its prompt cache; only the HumanMessage varies per case
+NURSE_SYS = "You are a nurse. Create a comprehensive patient summary focused on the skin condition."
+
+TRIAGE_SYS = """You are an experienced dermatology triage specialist. Analyze the patient's condition and determine the appropriate difficulty level:
+
+1) Basic: Can be handled by a single dermatologist
+   - Common conditions like acne, eczema, or simple rashes
+   - Clear symptoms and typical presentation
+   - Standard treatment protocols available
+
+2) Intermediate: Requires consultation between multiple dermatology specialists
+   - Complex conditions requiring multiple specialist perspectives
+   - Unclear diagnosis requiring additional tests
+   - Multiple treatment options to consider
+
+3) Advanced: Requires collaboration between multiple dermatology teams
+   - Rare or severe conditions
+   - Multiple comorbidities or complications
+   - High-risk cases requiring coordinated care
+   - Surgical intervention likely needed
+
+Respond only with "Basic", "Intermediate", or "Advanced" followed by a brief justification."""
+
+MEDICAL_SYS = """You are a medical dermatologist. Based on the patient's skin condition, provide:
+1. Detailed clinical assessment
+2. Differential diagnoses
+3. Recommended diagnostic tests if needed
+4. Initial treatment considerations"""
+
+SURGICAL_SYS = """You are a surgical dermatologist. Based on the patient's condition, provide:
+1. Surgical intervention assessment
+2. Procedural options and recommendations
+3. Risk-benefit analysis
+4. Surgical planning considerations"""
+
+PATHOLOGY_SYS = """You are a dermatopathologist. Based on the case information and specialist assessments, provide:
+1. Histopathological analysis
+2. Definitive diagnosis
+3. Disease staging if applicable
+4. Prognostic considerations
+5. Treatment recommendations based on pathological findings"""
+
+PHARMACIST_SYS = """You are a pharmacist. Based on the specialist assessments, provide:
+1. Comprehensive medication plan
+2. Detailed usage instructions
+3. Potential drug interactions
+4. Side effect monitoring
+5. Important precautions
+6. Lifestyle recommendations"""
+
+# Advanced cases ask for all three specialist assessments in one request, so the shared case
+# context is sent once; the pathologist section comes last and can build on the other two
+COMBINED_SYS = f"""You are a dermatology case conference. Write the three specialist assessments below in order.
+Start each section on its own line with its tag ([1], [2], [3]) and nothing before the first tag.
+
+[1] {MEDICAL_SYS}
+
+[2] {SURGICAL_SYS}
+
+[3] {PATHOLOGY_SYS}"""
+
+# Prompt templates are built once; nodes only fill in the case-specific variables
+TRIAGE_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", TRIAGE_SYS),
+    ("human", "Patient Information:\n{patient_info}\n\nSkin Condition Description:\n{skin_condition}")
+])
+NURSE_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", NURSE_SYS),
+    ("human", "Skin Condition: {skin_condition}\n\nPlease provide a well-structured summary for the dermatology team.")
+])
+MEDICAL_PROMPT = ChatPromptTemplate.from_messages([("system", MEDICAL_SYS), ("human", "{context}")])
+SURGICAL_PROMPT = ChatPromptTemplate.from_messages([("system", SURGICAL_SYS), ("human", "{context}")])
+COMBINED_PROMPT = ChatPromptTemplate.from_messages([("system", COMBINED_SYS), ("human", "{context}")])
+PATHOLOGY_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", PATHOLOGY_SYS),
+    ("human", "{context}\n\nMedical Dermatologist's Assessment:\n{medical_opinion}\n\nSurgical Dermatologist's Assessment:\n{surgical_opinion}")
+])
+PHARMACIST_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", PHARMACIST_SYS),
+    ("human", "{context}\n\nSpecialist Assessments:\n{specialist_opinions}")
+])
+
+SECTION_RE = re.compile(r"^\[(\d)\]", re.MULTILINE)
+
+def split_sections(content: str) -> Dict[str, str]:
+    """Split an [index]-tagged response into {index: section text}"""
+    parts = SECTION_RE.split(content)
+    return {index: text.strip() for index, text in zip(parts[1::2], parts[2::2])}
+
+# Deterministic triage for clear-cut descriptions; anything else goes to the LLM
+ADVANCED_RE = re.compile(
+    r"\b(melanoma|carcinoma|biopsy|ulcer(?:s|ated|ation)?|necro(?:sis|tic)|bleeding mole|(?:lesion|mole) (?:grew|growing|changed))\b",
+    re.IGNORECASE
+)
+BASIC_RE = re.compile(r"\b(acne|pimples?|eczema|rash(?:es)?|dry skin|dryness|dandruff)\b", re.IGNORECASE)
+# Signs that a common condition may not be a Basic case after all
+ESCALATION_RE = re.compile(r"\b(severe|cyst(?:ic|s)?|nodul(?:e|es|ar)|spreading|fever|infect\w*|scarring|not (?:improving|responding))\b", re.IGNORECASE)
+
+def triage_by_keywords(text: str) -> str:
+    """Return a difficulty level for obvious cases, or an empty string when unsure"""
+    if ADVANCED_RE.search(text):
+        return "Advanced"
+    if BASIC_RE.search(text) and not ESCALATION_RE.search(text):
+        return "Basic"
+    return ""
+
+async def determine_difficulty(skin_condition: str, llm, patient_info: str = "") -> str:
     """Determine the difficulty level of the case based on patient information and symptoms"""
-    patient_info = state["patient_info"]["summary"] if state.get("patient_info") else ""
-    skin_condition = state["skin_condition"]
+    difficulty = triage_by_keywords(f"{skin_condition} {patient_info}")
+    if difficulty:
+        return difficulty
     
-    assessment = llm.invoke([
-        SystemMessage(content="""You are an experienced dermatology triage specialist. Analyze the patient's condition and determine the appropriate difficulty level:
-
-        1) Basic: Can be handled by a single dermatologist
-           - Common conditions like acne, eczema, or simple rashes
-           - Clear symptoms and typical presentation
-           - Standard treatment protocols available
-           
-        2) Intermediate: Requires consultation between multiple dermatology specialists
-           - Complex conditions requiring multiple specialist perspectives
-           - Unclear diagnosis requiring additional tests
-           - Multiple treatment options to consider
-           
-        3) Advanced: Requires collaboration between multiple dermatology teams
-           - Rare or severe conditions
-           - Multiple comorbidities or complications
-           - High-risk cases requiring coordinated care
-           - Surgical intervention likely needed
-           
-        Respond only with "Basic", "Intermediate", or "Advanced" followed by a brief justification."""),
-        HumanMessage(content=f"""
-        Patient Information:
-        {patient_info}
-        
-        Skin Condition Description:
-        {skin_condition}
-        """)
-    ])
+    # Kept out of the token stream: it runs alongside the nurse summary in the same node,
+    # and its tokens would interleave with the summary's
+    assessment = await llm.with_config(tags=[TAG_NOSTREAM]).ainvoke(
+        TRIAGE_PROMPT.format_messages(patient_info=patient_info, skin_condition=skin_condition)
+    )
     
-    difficulty = assessment.content.split("\n")[0].strip()
+    difficulty = assessment.content.partition("\n")[0].strip()
     return difficulty
 
-def create_dermatology_graph():
-    # Initialize graph
-    workflow = StateGraph(DermatologyState)
-    
-    # Initialize LLM using OpenAI directlynm
-    llm = AzureChatOpenAI(
+async def cached_specialist_invoke(llm, ns: str, messages, key: str) -> AIMessage:
+    """Invoke a specialist, reusing an earlier answer for a semantically similar case"""
+    if not SEMANTIC_CACHE_ENABLED:
+        return await llm.ainvoke(messages)
+
+    # Embed the case text alone: the embedding model truncates long input, and the fixed
+    # system prompt would otherwise crowd the case out of it.
+    # Embedding and Chroma calls are blocking, so keep them off the event loop
+    embedding = await asyncio.to_thread(embed_messages, [HumanMessage(content=key)])
+    cached = await asyncio.to_thread(lookup, messages, ns, embedding=embedding)
+    if cached is not None:
+        return AIMessage(content=cached)
+
+    response = await llm.ainvoke(messages)
+    await asyncio.to_thread(store, messages, ns, response.content, embedding=embedding)
+    return response
+
+# One keep-alive pool for every consultation, so requests skip the TLS handshake.
+# HTTP/2 needs the optional h2 package (httpx[http2]).
+http_async_client = httpx.AsyncClient(
+    http2=importlib.util.find_spec("h2") is not None,
+    limits=httpx.Limits(max_connections=32, max_keepalive_connections=32),
+    timeout=60.0
+)
+
+def create_llm(deployment_name: str) -> AzureChatOpenAI:
+    return AzureChatOpenAI(
         api_key=os.getenv("AZURE_OAI_API_KEY"),
-        deployment_name="gpt-4o-mini",
-        api_version="2023-03-15-preview"
+        deployment_name=deployment_name,
+        # Structured output needs tool calling, which 2023-03-15-preview lacks
+        api_version="2024-02-15-preview",
+        http_async_client=http_async_client
     )
 
+# Triage, the nurse summary and the pharmacist's structured plan stay on the small model;
+# SPECIALIST_DEPLOYMENT lets the diagnostic consults run on a larger one (e.g. gpt-4o)
+llm = create_llm("gpt-4o-mini")
+specialist_llm = create_llm(os.getenv("SPECIALIST_DEPLOYMENT", "gpt-4o-mini"))
+# include_raw reports a failed parse instead of raising, so the pharmacist can fall back to text
+prescription_llm = llm.with_structured_output(Prescription, include_raw=True)
+
+# Routing tables keyed on difficulty_level; unknown levels fall back to the default route / END
+INTAKE_ROUTES = {
+    "Basic": ["medical_dermatologist"],
+    "Intermediate": ["medical_dermatologist", "surgical_dermatologist"],
+    "Advanced": ["combined_specialists"],
+}
+DEFAULT_INTAKE_ROUTE = INTAKE_ROUTES["Intermediate"]
+COMPLETENESS_ROUTES = {
+    "Basic": "pharmacist",
+    "Intermediate": "pharmacist",
+    "Advanced": "dermatopathologist",
+}
+
+# The graph only depends on the checkpointer, so compile it once per checkpointer
+@lru_cache(maxsize=2)
+def create_dermatology_graph(checkpointer=None):
+    # Initialize graph
+    workflow = StateGraph(DermatologyState)
+
     # Define agent nodes
-    def patient_intake_node(state: DermatologyState):
+    async def patient_intake_node(state: DermatologyState):
         """Node for collecting patient info"""
-        messages = state.get("messages", [])
+        messages = state.messages
         current_msg = messages[-1].content if messages else ""
         
-        # Compile information
-        summary = llm.invoke([
-            SystemMessage(content="You are a nurse. Create a comprehensive patient summary focused on the skin condition."),
-            HumanMessage(content=f"""
-                Skin Condition: {current_msg}
-                
-                Please provide a well-structured summary for the dermatology team.
-            """)
-        ])
+        # Compile information, triaging the raw description at the same time; the summary
+        # is derived from that same text, so waiting for it adds a round trip and no facts
+        summary, difficulty = await asyncio.gather(
+            llm.ainvoke(NURSE_PROMPT.format_messages(skin_condition=current_msg)),
+            determine_difficulty(current_msg, llm)
+        )
         
         state_update = {
-            "messages": [AIMessage(content=summary.content)],
+            # The model's own message keeps its id, so it is not re-sent as a new message
+            "messages": [summary],
             "patient_info": {
                 "skin_concerns": current_msg,
                 "summary": summary.content
             },
-            "skin_condition": current_msg
+            "skin_condition": current_msg,
+            # Built once so every specialist prompt opens with the same bytes
+            "context_block": f"Patient Skin Condition:\n{current_msg}\n\nPatient Information:\n{summary.content}",
+            "difficulty_level": difficulty
         }
         
-        # Determine difficulty level
-        difficulty = determine_difficulty(state_update, llm)
-        state_update["difficulty_level"] = difficulty
-        
         return state_update
 
-    def medical_dermatologist_node(state: DermatologyState):
+    async def medical_dermatologist_node(state: DermatologyState):
         """Medical dermatologist node focused on dermatological assessment"""
-        patient_info = state["patient_info"]["summary"]
-        skin_condition = state["skin_condition"]
-        
-        medical_opinion = llm.invoke([
-            SystemMessage(content="""You are a medical dermatologist. Based on the patient's skin condition, provide:
-            1. Detailed clinical assessment
-            2. Differential diagnoses
-            3. Recommended diagnostic tests if needed
-            4. Initial treatment considerations"""),
-            HumanMessage(content=f"""
-            Patient Skin Condition:
-            {skin_condition}
-            
-            Patient Information:
-            {patient_info}
-            """)
-        ])
+        messages = MEDICAL_PROMPT.format_messages(context=state.context_block)
+        medical_opinion = await cached_specialist_invoke(specialist_llm, "medical_dermatologist", messages, state.context_block)
         
         return {
             "medical_dermatologist_consult": {
@@ -151,29 +353,11 @@ def create_dermatology_graph():
             "messages": [AIMessage(content="Medical Dermatologist Assessment:\n" + medical_opinion.content)]
         }
 
-    def surgical_dermatologist_node(state: DermatologyState):
+    async def surgical_dermatologist_node(state: DermatologyState):
         """Surgical dermatologist node focused on surgical assessment"""
-        patient_info = state["patient_info"]["summary"]
-        skin_condition = state["skin_condition"]
-        medical_opinion = state["medical_dermatologist_consult"]["opinion"]
-        
-        surgical_opinion = llm.invoke([
-            SystemMessage(content="""You are a surgical dermatologist. Based on the patient's condition and medical assessment, provide:
-            1. Surgical intervention assessment
-            2. Procedural options and recommendations
-            3. Risk-benefit analysis
-            4. Surgical planning considerations"""),
-            HumanMessage(content=f"""
-            Patient Skin Condition: 
-            {skin_condition}
-            
-            Medical Dermatologist's Assessment:
-            {medical_opinion}
-            
-            Patient Information:
-            {patient_info}
-            """)
-        ])
+        # Runs alongside the medical dermatologist, so it works from the intake alone
+        messages = SURGICAL_PROMPT.format_messages(context=state.context_block)
+        surgical_opinion = await cached_specialist_invoke(specialist_llm, "surgical_dermatologist", messages, state.context_block)
         
         return {
             "surgical_dermatologist_consult": {
@@ -183,165 +367,152 @@ def create_dermatology_graph():
             "messages": [AIMessage(content="Surgical Dermatologist Assessment:\n" + surgical_opinion.content)]
         }
 
-    def dermatopathologist_node(state: DermatologyState):
+    async def dermatopathologist_node(state: DermatologyState):
         """Dermatopathologist node focused on tissue analysis and diagnosis"""
-        patient_info = state["patient_info"]["summary"]
-        skin_condition = state["skin_condition"]
-        medical_opinion = state["medical_dermatologist_consult"]["opinion"]
-        surgical_opinion = state["surgical_dermatologist_consult"]["opinion"]
+        medical_opinion = state.medical_dermatologist_consult["opinion"]
+        surgical_opinion = state.surgical_dermatologist_consult["opinion"]
         
-        pathology_review = llm.invoke([
-            SystemMessage(content="""You are a dermatopathologist. Based on the case information and specialist assessments, provide:
-            1. Histopathological analysis
-            2. Definitive diagnosis
-            3. Disease staging if applicable
-            4. Prognostic considerations
-            5. Treatment recommendations based on pathological findings"""),
-            HumanMessage(content=f"""
-            Patient Skin Condition:
-            {skin_condition}
-            
-            Medical Dermatologist's Assessment:
-            {medical_opinion}
-            
-            Surgical Dermatologist's Assessment:
-            {surgical_opinion}
-            
-            Patient Information:
-            {patient_info}
-            """)
-        ])
+        messages = PATHOLOGY_PROMPT.format_messages(
+            context=state.context_block,
+            medical_opinion=medical_opinion,
+            surgical_opinion=surgical_opinion
+        )
+        # Not semantically cached: the upstream opinions it reviews would fall outside the key
+        pathology_review = await specialist_llm.ainvoke(messages)
         
+        # First line is the diagnosis, the rest the treatment plan
+        diagnosis, _, treatment_plan = pathology_review.content.partition("\n")
         return {
             "dermatopathologist_consult": {
                 "opinion": pathology_review.content,
                 "status": "completed"
             },
-            "diagnosis": pathology_review.content.split("\n")[0].strip(),
-            "treatment_plan": "\n".join(pathology_review.content.split("\n")[1:]).strip(),
+            "diagnosis": diagnosis.strip(),
+            "treatment_plan": treatment_plan.strip(),
             "messages": [AIMessage(content="Dermatopathologist Assessment:\n" + pathology_review.content)]
         }
 
-    def pharmacist_node(state: DermatologyState):
-        """Pharmacist node focused on medication management"""
-        patient_info = state["patient_info"]["summary"]
-        skin_condition = state["skin_condition"]
+    async def combined_specialist_node(state: DermatologyState):
+        """All three specialist assessments for an Advanced case from a single request"""
+        messages = COMBINED_PROMPT.format_messages(context=state.context_block)
+        review = await cached_specialist_invoke(specialist_llm, "combined_specialists", messages, state.context_block)
+        
+        sections = split_sections(review.content)
+        if not all(sections.get(index) for index in ("1", "2", "3")):
+            # Leave the consults pending so the case falls back to the per-specialist nodes
+            return {}
         
+        medical_opinion, surgical_opinion, pathology_opinion = sections["1"], sections["2"], sections["3"]
+        diagnosis, _, treatment_plan = pathology_opinion.partition("\n")
+        return {
+            "medical_dermatologist_consult": {
+                "opinion": medical_opinion,
+                "status": "completed"
+            },
+            "surgical_dermatologist_consult": {
+                "opinion": surgical_opinion,
+                "status": "completed"
+            },
+            "dermatopathologist_consult": {
+                "opinion": pathology_opinion,
+                "status": "completed"
+            },
+            "diagnosis": diagnosis.strip(),
+            "treatment_plan": treatment_plan.strip(),
+            "messages": [
+                AIMessage(content="Medical Dermatologist Assessment:\n" + medical_opinion),
+                AIMessage(content="Surgical Dermatologist Assessment:\n" + surgical_opinion),
+                AIMessage(content="Dermatopathologist Assessment:\n" + pathology_opinion)
+            ]
+        }
+
+    async def pharmacist_node(state: DermatologyState):
+        """Pharmacist node focused on medication management"""
         # Gather available specialist opinions
         specialist_opinions = f"""
-        Medical Assessment: {state['medical_dermatologist_consult']['opinion']}
+        Medical Assessment: {state.medical_dermatologist_consult['opinion']}
         """
-        if state.get("surgical_dermatologist_consult", {}).get("opinion"):
-            specialist_opinions += f"\nSurgical Assessment: {state['surgical_dermatologist_consult']['opinion']}"
-        if state.get("dermatopathologist_consult", {}).get("opinion"):
-            specialist_opinions += f"\nPathology Assessment: {state['dermatopathologist_consult']['opinion']}"
+        if state.surgical_dermatologist_consult.get("opinion"):
+            specialist_opinions += f"\nSurgical Assessment: {state.surgical_dermatologist_consult['opinion']}"
+        if state.dermatopathologist_consult.get("opinion"):
+            specialist_opinions += f"\nPathology Assessment: {state.dermatopathologist_consult['opinion']}"
         
-        prescription_review = llm.invoke([
-            SystemMessage(content="""You are a pharmacist. Based on the specialist assessments, provide:
-            1. Comprehensive medication plan
-            2. Detailed usage instructions
-            3. Potential drug interactions
-            4. Side effect monitoring
-            5. Important precautions
-            6. Lifestyle recommendations"""),
-            HumanMessage(content=f"""
-            Patient Information:
-            {patient_info}
-            
-            Skin Condition:
-            {skin_condition}
-            
-            Specialist Assessments:
-            {specialist_opinions}
-            """)
-        ])
+        messages = PHARMACIST_PROMPT.format_messages(
+            context=state.context_block,
+            specialist_opinions=specialist_opinions
+        )
+        # Not semantically cached: the upstream opinions it reviews would fall outside the key
+        result = await prescription_llm.ainvoke(messages)
         
+        if result["parsed"] is not None:
+            prescription = format_prescription(result["parsed"])
+        else:
+            # Keep the consultation alive with a free-text plan rather than failing it
+            prescription = (await llm.ainvoke(messages)).content
+        # The API keeps returning the prescription as text
         return {
-            "prescription": prescription_review.content,
-            "messages": [AIMessage(content="Pharmacist's Recommendations:\n" + prescription_review.content)]
+            "prescription": prescription,
+            "messages": [AIMessage(content="Pharmacist's Recommendations:\n" + prescription)]
         }
 
-    def route_by_medical_consult(state: DermatologyState) -> str:
-        """Route based on medical consult and difficulty level"""
-        difficulty = state["difficulty_level"]
-        medical_status = state["medical_dermatologist_consult"]["status"]
-        
-        if medical_status == "completed":
-            if difficulty == "Basic":
-                return "pharmacist"
-            else:  # Intermediate or Advanced
-                return "surgical_dermatologist"
-        
-        if not state.get("messages", []):
-            return "medical_dermatologist"
-        
-        return END
+    def route_by_difficulty(state: DermatologyState) -> List[str]:
+        """Route intake to the specialists by difficulty level"""
+        return INTAKE_ROUTES.get(state.difficulty_level, DEFAULT_INTAKE_ROUTE)
+    
+    def route_by_combined_consult(state: DermatologyState) -> List[str]:
+        """Go to the pharmacist, or fall back to separate consults if the combined reply did not parse"""
+        if state.dermatopathologist_consult["status"] == "completed":
+            return ["pharmacist"]
+        return ["medical_dermatologist", "surgical_dermatologist"]
             
     def route_by_completeness(state: DermatologyState) -> str:
-        """Route by completeness and difficulty level"""
-        difficulty = state["difficulty_level"]
-        medical_status = state["medical_dermatologist_consult"]["status"]
-        surgical_status = state["surgical_dermatologist_consult"]["status"]
-        
-        if medical_status == "completed" and surgical_status == "completed":
-            if difficulty == "Advanced":
-                return "dermatopathologist"
-            elif difficulty == "Intermediate":
-                return "pharmacist"
-                
-        if not state.get("messages", []):
-            return "surgical_dermatologist"
-            
-        return END
+        """Route to the next stage once the specialist consults are in"""
+        # Decided by difficulty alone: each parallel branch routes from its own view of the
+        # state, which does not yet include its sibling's consult
+        return COMPLETENESS_ROUTES.get(state.difficulty_level, END)
     
     # Add nodes
     workflow.add_node("patient_intake", patient_intake_node)
     workflow.add_node("medical_dermatologist", medical_dermatologist_node)
     workflow.add_node("surgical_dermatologist", surgical_dermatologist_node)
     workflow.add_node("dermatopathologist", dermatopathologist_node)
+    workflow.add_node("combined_specialists", combined_specialist_node)
     workflow.add_node("pharmacist", pharmacist_node)
 
     # Add edges with proper routing
     workflow.add_edge(START, "patient_intake")
-    workflow.add_edge("patient_intake", "medical_dermatologist")
-    
     workflow.add_conditional_edges(
-        "medical_dermatologist",
-        route_by_medical_consult,
-        {
-            "medical_dermatologist": "medical_dermatologist",
-            "surgical_dermatologist": "surgical_dermatologist",
-            "pharmacist": "pharmacist",
-            END: END
-        }
+        "patient_intake",
+        route_by_difficulty,
+        ["medical_dermatologist", "surgical_dermatologist", "combined_specialists"]
     )
     
     workflow.add_conditional_edges(
-        "surgical_dermatologist",
-        route_by_completeness,
-        {
-            "surgical_dermatologist": "surgical_dermatologist",
-            "dermatopathologist": "dermatopathologist",
-            "pharmacist": "pharmacist",
-            END: END
-        }
+        "combined_specialists",
+        route_by_combined_consult,
+        ["medical_dermatologist", "surgical_dermatologist", "pharmacist"]
     )
     
+    # Both consults route to the same next node, which LangGraph runs once after
+    # the parallel step completes
+    for specialist in ("medical_dermatologist", "surgical_dermatologist"):
+        workflow.add_conditional_edges(
+            specialist,
+            route_by_completeness,
+            ["dermatopathologist", "pharmacist", END]
+        )
+    
     workflow.add_edge("dermatopathologist", "pharmacist")
     workflow.add_edge("pharmacist", END)
 
-    return workflow.compile()
+    return workflow.compile(checkpointer=checkpointer)
 
-@app.post("/process_input")
-async def process_input(body: dict):
-    data = body
-    user_input = data.get('input', '')
-
-    # Initialize state
-    initial_state = {
+def build_initial_state(user_input: str) -> dict:
+    return {
         "messages": [HumanMessage(content=user_input)],
         "patient_info": {},
         "skin_condition": "",
+        "context_block": "",
         "difficulty_level": "",
         "medical_dermatologist_consult": {"status": "pending"},
         "surgical_dermatologist_consult": {"status": "pending"},
@@ -351,10 +522,7 @@ async def process_input(body: dict):
         "prescription": ""
     }
 
-    # Run graph and capture outputs
-    graph = create_dermatology_graph()
-    final_state = graph.invoke(initial_state)
-
+def format_response(final_state: dict) -> dict:
     # Extract and format messages
     messages = final_state.get('messages', [])
     message_list = []
@@ -376,8 +544,7 @@ async def process_input(body: dict):
         else:
             message_list.append({'sender': 'system', 'content': str(msg.content), 'type': 'message'})
 
-    # Prepare response
-    response = {
+    return {
         "messages": message_list,
         "state": {
             "difficulty_level": final_state['difficulty_level'],
@@ -388,6 +555,108 @@ async def process_input(body: dict):
         "endOfConversation": True
     }
 
+async def prepare_run(user_input: str, thread_id: str = None):
+    """Return the graph, its input, run config and thread id for a consultation request"""
+    checkpointer = await get_checkpointer()
+    graph = create_dermatology_graph(checkpointer)
+    if checkpointer is None:
+        return graph, build_initial_state(user_input), None, None
+
+    thread_id = thread_id or str(uuid.uuid4())
+    config = {"configurable": {"thread_id": thread_id}}
+    snapshot = await graph.aget_state(config)
+    if snapshot.next:
+        # Interrupted run: continue from the last checkpoint instead of redoing finished nodes
+        return graph, None, config, thread_id
+    # New or finished thread: start a run for this input
+    return graph, build_initial_state(user_input), config, thread_id
+
+async def run_consultation(user_input: str, thread_id: str = None) -> dict:
+    graph, graph_input, config, thread_id = await prepare_run(user_input, thread_id)
+    final_state = await graph.ainvoke(graph_input, config)
+
+    response = format_response(final_state)
+    if thread_id:
+        response["thread_id"] = thread_id
+    return response
+
+@app.post("/process_input")
+async def process_input(body: dict):
+    data = body
+    user_input = data.get('input', '')
+
+    response = await run_consultation(user_input, data.get('thread_id'))
+    return JSONResponse(response)
+
+@app.post("/process_input/stream")
+async def stream_input(body: dict):
+    """Stream specialist tokens as newline-delimited JSON, then the usual response payload"""
+    user_input = body.get('input', '')
+    graph, graph_input, config, thread_id = await prepare_run(user_input, body.get('thread_id'))
+
+    async def events():
+        final_state = {}
+        async for mode, chunk in graph.astream(graph_input, config, stream_mode=["messages", "values"]):
+            if mode == "values":
+                final_state = chunk
+                continue
+            message, metadata = chunk
+            # Only model tokens: complete messages a node returns are emitted again when it
+            # finishes, and are already in the final payload. Structured pharmacist output
+            # arrives as tool-call arguments, not content.
+            if isinstance(message, AIMessageChunk) and message.content:
+                yield json.dumps({"type": "token", "node": metadata["langgraph_node"], "content": message.content}) + "\n"
+
+        response = format_response(final_state)
+        if thread_id:
+            response["thread_id"] = thread_id
+        yield json.dumps({"type": "final", **response}) + "\n"
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
+# Background consultations, for hosts whose request timeout is shorter than a full consultation: start the run,
+# return a job id at once and let the client poll for the result.
+# Jobs live in this process's memory, so run a single worker when using these endpoints.
+# A finished job is dropped once its result is read, or after JOB_TTL_SECONDS if never polled,
+# so patient data does not stay in memory.
+jobs: Dict[str, dict] = {}
+JOB_TTL_SECONDS = 60 * 60
+
+def sweep_jobs():
+    cutoff = time.time() - JOB_TTL_SECONDS
+    for job_id in [job_id for job_id, job in jobs.items() if job.get("finished_at", float("inf")) < cutoff]:
+        del jobs[job_id]
+
+async def run_job(job_id: str, user_input: str, thread_id: str = None):
+    try:
+        jobs[job_id] = {"status": "completed", "result": await run_consultation(user_input, thread_id)}
+    except Exception as e:
+        jobs[job_id] = {"status": "failed", "error": str(e)}
+    jobs[job_id]["finished_at"] = time.time()
+
+@app.post("/process_input/async")
+async def start_consultation(body: dict):
+    sweep_jobs()
+    user_input = body.get('input', '')
+    job_id = str(uuid.uuid4())
+    jobs[job_id] = {"status": "running"}
+    jobs[job_id]["task"] = asyncio.create_task(run_job(job_id, user_input, body.get('thread_id')))
+    return JSONResponse({"job_id": job_id, "status": "running"}, status_code=202)
+
+@app.get("/status/{job_id}")
+async def consultation_status(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job id")
+
+    response = {"job_id": job_id, "status": job["status"]}
+    if job["status"] == "completed":
+        response.update(job["result"])
+    elif job["status"] == "failed":
+        response["error"] = job["error"]
+    if job["status"] != "running":
+        # The final result is handed out once
+        del jobs[job_id]
     return JSONResponse(response)
 
 if __name__ == "__main__":
@@ -0,0 +1,62 @@
+import time
+import uuid
+from functools import lru_cache
+from typing import Optional
+
+from derma_bot.retrival.core import HNSW_METADATA, logger, init_chroma
+
+CACHE_COLLECTION_NAME = "llm_response_cache"
+SIMILARITY_THRESHOLD = 0.92
+CACHE_TTL_SECONDS = 24 * 60 * 60
+
+
+@lru_cache(maxsize=1)
+def init_cache():
+    client, _, model = init_chroma()
+    # Cosine space so a query's distance is directly 1 - similarity
+    collection = client.get_or_create_collection(
+        name=CACHE_COLLECTION_NAME,
+        metadata=HNSW_METADATA
+    )
+    return collection, model
+
+
+def serialize_messages(messages) -> str:
+    return "\n".join(f"{message.type}: {message.content}" for message in messages)
+
+
+def embed_messages(messages) -> list:
+    _, model = init_cache()
+    return model.encode(serialize_messages(messages), normalize_embeddings=True).tolist()
+
+
+def lookup(messages, ns: str, threshold: float = SIMILARITY_THRESHOLD, embedding: Optional[list] = None) -> Optional[str]:
+    collection, _ = init_cache()
+    if collection.count() == 0:
+        return None
+
+    embedding = embedding or embed_messages(messages)
+    results = collection.query(
+        query_embeddings=[embedding],
+        n_results=1,
+        where={"$and": [{"ns": ns}, {"ts": {"$gte": time.time() - CACHE_TTL_SECONDS}}]}
+    )
+    if not results['documents'] or not results['documents'][0]:
+        return None
+
+    distance = results['distances'][0][0]
+    if distance < 1 - threshold:
+        logger.info(f"Semantic cache hit in '{ns}' (distance {distance:.4f})")
+        return results['documents'][0][0]
+    return None
+
+
+def store(messages, ns: str, response: str, embedding: Optional[list] = None) -> None:
+    collection, _ = init_cache()
+    collection.add(
+        ids=[str(uuid.uuid4())],
+        embeddings=[embedding or embed_messages(messages)],
+        documents=[response],
+        metadatas=[{"ns": ns, "ts": time.time()}]
+    )
+
@@ -0,0 +1,38 @@
+from functools import lru_cache
+from typing import Optional
+
+import numpy as np
+
+from derma_bot.retrival.core import logger, encode_batch
+
+# Lay phrasings that map onto the conditions the pharmacy stocks
+CONDITION_SYNONYMS = {
+    "hair loss": ["hair loss", "alopecia", "balding", "thinning hair", "receding hairline"],
+    "acne": ["acne", "pimples", "zits", "breakouts", "blackheads", "whiteheads"],
+    "rosacea": ["rosacea", "facial redness", "flushing cheeks", "red bumps on the face"],
+    "mole": ["mole", "nevus", "dark spot on the skin", "skin growth"],
+    "rash": ["rash", "hives", "skin irritation", "red itchy patches"],
+    "eczema": ["eczema", "atopic dermatitis", "dry itchy skin"],
+    "psoriasis": ["psoriasis", "scaly plaques", "silvery scales on the skin"],
+}
+MATCH_THRESHOLD = 0.55
+
+
+@lru_cache(maxsize=1)
+def condition_matrix():
+    # Every synonym is encoded once; FP16 halves the matrix read on each match
+    labels = [condition for condition, synonyms in CONDITION_SYNONYMS.items() for _ in synonyms]
+    texts = [synonym for synonyms in CONDITION_SYNONYMS.values() for synonym in synonyms]
+    matrix = np.ascontiguousarray(encode_batch(texts), dtype=np.float16)
+    logger.info(f"Encoded {len(texts)} condition synonyms")
+    return labels, matrix
+
+
+def match_condition(diagnosis: str, threshold: float = MATCH_THRESHOLD) -> Optional[str]:
+    labels, matrix = condition_matrix()
+    query = encode_batch([diagnosis])[0].astype(np.float16)
+    scores = matrix @ query
+    idx = int(scores.argmax())
+    if scores[idx] > threshold:
+        return labels[idx]
+    return None
@@ -1,7 +1,9 @@
 import logging
+import os
+from functools import lru_cache
 
 import chromadb
-from chromadb.errors import InvalidCollectionException
+import torch
 from sentence_transformers import SentenceTransformer
 
 logging.basicConfig(
@@ -10,17 +12,52 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+MODEL_NAME = 'sentence-transformers/all-mpnet-base-v2'
+# "onnx-int8" serves CPU embeddings from the dynamically quantized ONNX export
+# (needs optimum[onnxruntime]); anything else keeps the default PyTorch backend.
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+ONNX_INT8_FILE = "onnx/model_qint8_avx512_vnni.onnx"
+# MPNet embeddings are normalized, so rank by cosine; a denser graph trades build time for recall.
+# Chroma only applies these when a collection is created.
+HNSW_METADATA = {
+    "hnsw:space": "cosine",
+    "hnsw:M": 32,
+    "hnsw:construction_ef": 200,
+    "hnsw:search_ef": 64,
+}
 
+
+@lru_cache(maxsize=1)
 def init_chroma():
+    # Loading MPNet and opening the persistent store is expensive, so do it once per process
     logger.info("Initializing ChromaDB client")
     client = chromadb.PersistentClient(path="./data")
     collection_name = "synthetic_documents"
-    try:
-        collection = client.get_collection(name=collection_name)
-    except InvalidCollectionException:
-        collection = client.create_collection(name=collection_name)
+    collection = client.get_or_create_collection(name=collection_name, metadata=HNSW_METADATA)
 
     logger.info("Loading sentence transformer model")
-    model = SentenceTransformer('sentence-transformers/all-mpnet-base-v2')
+    model = load_model()
+
+    return client, collection, model
+
+
+def load_model():
+    if torch.cuda.is_available():
+        model = SentenceTransformer(MODEL_NAME, device='cuda')
+        model.half()
+        return model
+
+    if EMBEDDING_BACKEND == "onnx-int8":
+        logger.info(f"Using int8 ONNX backend ({ONNX_INT8_FILE})")
+        return SentenceTransformer(
+            MODEL_NAME,
+            backend="onnx",
+            model_kwargs={"file_name": ONNX_INT8_FILE}
+        )
+
+    return SentenceTransformer(MODEL_NAME, device='cpu')
+
 
-    return client, collection, model
\ No newline at end of file
+def encode_batch(texts):
+    _, _, model = init_chroma()
+    return model.encode(texts, batch_size=64, convert_to_numpy=True, normalize_embeddings=True)
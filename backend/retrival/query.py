@@ -1,6 +1,6 @@
 import logging
 
-from derma_bot.retrival.core import init_chroma
+from derma_bot.retrival.core import init_chroma, encode_batch
 
 logging.basicConfig(
     level=logging.INFO,
@@ -11,7 +11,7 @@ logger = logging.getLogger(__name__)
 
 def query(query_text: str):
     client, collection, model = init_chroma()
-    query_embedding = model.encode([query_text]).tolist()
+    query_embedding = encode_batch([query_text]).tolist()
     results = collection.query(
         query_embeddings=query_embedding,
         n_results=2
@@ -8,7 +8,7 @@ from chromadb.errors import InvalidCollectionException
 from pydantic import BaseModel
 from sentence_transformers import SentenceTransformer
 
-from derma_bot.retrival.core import logger, init_chroma
+from derma_bot.retrival.core import logger, init_chroma, encode_batch
 
 N = 10
 
@@ -60,20 +60,19 @@ async def generate_document() -> str:
 
 async def main():
     client, collection, model = init_chroma()
-    
-    for i in range(N):
-        document = await generate_document()
-
-        logger.info(f"Encoding document: {document}")
-        embedding = model.encode([document])
-        
-        logger.info(f"Adding document {i+1} to collection")
-        collection.add(
-            documents=[document],
-            embeddings=embedding.tolist(),
-            ids=[f"doc_{i}"],
-            metadatas=[{"source": "example"}]
-        )
+
+    documents = [await generate_document() for _ in range(N)]
+
+    logger.info(f"Encoding {len(documents)} documents")
+    embeddings = encode_batch(documents)
+
+    logger.info(f"Adding {len(documents)} documents to collection")
+    collection.add(
+        documents=documents,
+        embeddings=embeddings.tolist(),
+        ids=[f"doc_{i}" for i in range(N)],
+        metadatas=[{"source": "example"} for _ in range(N)]
+    )
 
 
 if __name__ == "__main__":
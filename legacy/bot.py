@@ -1,34 +1,45 @@
 import os
 import asyncio
+import itertools
 from dotenv import load_dotenv
 from autogen import ConversableAgent
+from autogen.cache import Cache
 import discord
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Fetch Cerebras API keys
-CEREBRAS_API_KEY = os.getenv("CEREBRAS_API_KEY")
-
-# Fetch Discord tokens
-DISCORD_TOKEN_DRSASHA = os.getenv("DISCORD_TOKEN_DRSASHA")
-DISCORD_TOKEN_GMKATIE = os.getenv("DISCORD_TOKEN_GMKATIE")
-DISCORD_TOKEN_PHARMABRO = os.getenv("DISCORD_TOKEN_PHARMABRO")
+# Cerebras API key, plus the Discord token; DrSasha and PharmaBro post through a channel
+# webhook instead of their own bots
+REQUIRED_ENV_VARS = ("CEREBRAS_API_KEY", "DISCORD_TOKEN_GMKATIE")
 
 # Verify that all tokens are loaded
-missing_vars = []
-if not CEREBRAS_API_KEY:
-    missing_vars.append("CEREBRAS_API_KEY")
-if not DISCORD_TOKEN_DRSASHA:
-    missing_vars.append("DISCORD_TOKEN_DRSASHA")
-if not DISCORD_TOKEN_GMKATIE:
-    missing_vars.append("DISCORD_TOKEN_GMKATIE")
-if not DISCORD_TOKEN_PHARMABRO:
-    missing_vars.append("DISCORD_TOKEN_PHARMABRO")
-
+missing_vars = [var for var in REQUIRED_ENV_VARS if not os.environ.get(var)]
 if missing_vars:
     raise EnvironmentError(f"Missing environment variables: {', '.join(missing_vars)}")
 
+CEREBRAS_API_KEY, DISCORD_TOKEN_GMKATIE = (os.environ[var] for var in REQUIRED_ENV_VARS)
+
+# AutoGen replays identical prompts from its response cache instead of calling Cerebras again,
+# e.g. on a repeated .start or a retry after a Discord error. The default backend is a local
+# disk cache keyed by the seed; set REDIS_URL to share it across bot processes.
+AUTOGEN_CACHE_SEED = int(os.getenv("AUTOGEN_CACHE_SEED", "42"))
+REDIS_URL = os.getenv("REDIS_URL")
+response_cache = Cache.redis(cache_seed=AUTOGEN_CACHE_SEED, redis_url=REDIS_URL) if REDIS_URL else None
+
+# One Cerebras config shared by every agent, with a request timeout so a stalled call cannot hang a chat
+CEREBRAS_CFG = {
+    "config_list": [{
+        "model": "llama3.1-70b",
+        "api_key": CEREBRAS_API_KEY,
+        "base_url": "https://api.cerebras.ai/v1",
+        "api_type": "openai",
+        "temperature": 0.7
+    }],
+    "timeout": 60,
+    "cache_seed": AUTOGEN_CACHE_SEED,
+}
+
 # Define Conversable Agents
 
 # General Manager Katie
@@ -37,15 +48,7 @@ gmkatie = ConversableAgent(
     system_message=(
         "You are Katie, the General Manager. You receive queries from patients and coordinate with the Doctor and Pharma Person to address their needs."
     ),
-    llm_config={
-        "config_list": [{
-            "model": "llama3.1-70b",
-            "api_key": CEREBRAS_API_KEY,
-            "base_url": "https://api.cerebras.ai/v1",
-            "api_type": "openai",
-            "temperature": 0.7
-        }]
-    },
+    llm_config=CEREBRAS_CFG,
     human_input_mode="NEVER",
 )
 
@@ -55,15 +58,7 @@ drsasha = ConversableAgent(
     system_message=(
         "You are Dr. Sasha, a competent doctor. When instructed by the General Manager, you will assess patient information and write prescriptions."
     ),
-    llm_config={
-        "config_list": [{
-            "model": "llama3.1-70b",
-            "api_key": CEREBRAS_API_KEY,
-            "base_url": "https://api.cerebras.ai/v1",
-            "api_type": "openai",
-            "temperature": 0.7
-        }]
-    },
+    llm_config=CEREBRAS_CFG,
     human_input_mode="NEVER",
 )
 
@@ -73,93 +68,84 @@ pharmabro = ConversableAgent(
     system_message=(
         "You are PharmaBro, the Pharma Specialist. Based on the doctor's prescription, you decide on the appropriate medicine and provide recommendations."
     ),
-    llm_config={
-        "config_list": [{
-            "model": "llama3.1-70b",
-            "api_key": CEREBRAS_API_KEY,
-            "base_url": "https://api.cerebras.ai/v1",
-            "api_type": "openai",
-            "temperature": 0.7
-        }]
-    },
+    llm_config=CEREBRAS_CFG,
     human_input_mode="NEVER",
 )
 
-# Define Discord Clients for each bot
+# Define the Discord client; one Gateway connection serves all three personas
 intents = discord.Intents.default()
 intents.message_content = True
 
-# Create separate Discord clients
 client_gmkatie = discord.Client(intents=intents)
-client_drsasha = discord.Client(intents=intents)
-client_pharmabro = discord.Client(intents=intents)
 
-# Define asyncio Events to ensure all clients are ready
-gmkatie_ready = asyncio.Event()
-drsasha_ready = asyncio.Event()
-pharmabro_ready = asyncio.Event()
+# Webhook that lets a single bot post under each agent's name
+WEBHOOK_NAME = "pharma-agents"
+webhooks = {}
 
-# Helper function to extract all messages from ChatResult
-def extract_messages(chat_result):
+# Optional per-agent avatars, e.g. AVATAR_URL_DRSASHA
+AVATARS = {
+    name: os.getenv(f"AVATAR_URL_{name.upper()}")
+    for name in ('gmkatie', 'drsasha', 'pharmabro')
+}
+
+# Helper function to iterate over all messages from ChatResult
+def iter_messages(chat_result):
     """
-    Extracts all messages from the chat history in the ChatResult.
+    Yields the messages from the chat history in the ChatResult as they are read.
 
-    Returns:
-        List of tuples: [(sender_name, message_content), ...]
+    Yields:
+        Tuples: (sender_name, message_content)
     """
-    messages = []
     if not chat_result or not chat_result.chat_history:
-        return messages
+        return
 
     for message in chat_result.chat_history:
-        name = message.get('name')
-        content = message.get('content')
+        name, content = message.get('name'), message.get('content')
         if name and content:
-            messages.append((name.lower(), content))
-    return messages
+            yield name.lower(), content
 
-# Helper function to map agent name to Discord client
-def get_client_by_name(name):
+# Helper function to get the agents' webhook for a channel
+async def get_webhook(channel_id):
     """
-    Returns the Discord client based on the agent's name.
+    Returns the channel's agent webhook, reusing an existing one before creating it.
 
     Args:
-        name (str): Name of the agent (e.g., 'gmkatie').
+        channel_id (int): Discord channel ID where messages will be sent.
 
     Returns:
-        discord.Client: Corresponding Discord client.
+        discord.Webhook: Webhook used to post as any agent.
     """
-    name_to_client = {
-        'gmkatie': client_gmkatie,
-        'drsasha': client_drsasha,
-        'pharmabro': client_pharmabro,
-    }
-    return name_to_client.get(name.lower())
+    if channel_id in webhooks:
+        return webhooks[channel_id]
+
+    channel = client_gmkatie.get_channel(channel_id)
+    if channel is None:
+        # Fetch the channel if not found in cache
+        channel = await client_gmkatie.fetch_channel(channel_id)
+
+    webhook = discord.utils.get(await channel.webhooks(), name=WEBHOOK_NAME)
+    if webhook is None:
+        webhook = await channel.create_webhook(name=WEBHOOK_NAME)
+    webhooks[channel_id] = webhook
+    return webhook
 
 # Helper function to send messages to Discord
 async def send_messages(messages, channel_id):
     """
-    Sends a list of messages to the specified Discord channel.
+    Sends messages to the specified Discord channel as they are produced.
 
     Args:
-        messages (list): List of tuples containing (sender_name, message_content).
+        messages (iterable): Tuples containing (sender_name, message_content).
         channel_id (int): Discord channel ID where messages will be sent.
     """
+    webhook = await get_webhook(channel_id)
     for sender, content in messages:
-        client = get_client_by_name(sender)
-        if client is None:
+        if sender not in AVATARS:
             print(f"Unknown sender '{sender}'. Skipping message.")
             continue
 
         try:
-            channel = client.get_channel(channel_id)
-            if channel is None:
-                # Fetch the channel if not found in cache
-                channel = await client.fetch_channel(channel_id)
-
-            # Format the message with bold sender name
-            formatted_message = f"**{sender.upper()}:** {content}"
-            await channel.send(formatted_message)
+            await webhook.send(content=content, username=sender.upper(), avatar_url=AVATARS[sender])
             print(f"Sent message from {sender.upper()}: {content[:50]}...")  # Log first 50 chars
         except Exception as e:
             print(f"Error sending message from {sender.upper()}: {e}")
@@ -179,34 +165,33 @@ async def initiate_conversation(channel_id):
     gm_message = f"Patient Query: {patient_query}"
     print(f"GMKATIE: {gm_message}")
 
-    # Initiate chat between GMKATIE and DRSASHA
-    dr_chat = drsasha.initiate_chat(
+    # Initiate chat between GMKATIE and DRSASHA; AutoGen is synchronous, so run it off the event loop
+    dr_chat = await asyncio.to_thread(
+        drsasha.initiate_chat,
         gmkatie,
         message=f"Please provide a prescription based on the following patient query: {patient_query}",
-        max_turns=10  # Increase max_turns as needed
+        max_turns=10,  # Increase max_turns as needed
+        cache=response_cache
     )
 
-    # Extract all messages from DRSASHA's chat
-    dr_messages = extract_messages(dr_chat)
-
-    # Initiate chat between DRSASHA and PHARMABRO
-    pharma_chat = pharmabro.initiate_chat(
-        drsasha,
-        message=f"Based on the following prescription, please decide on the appropriate medicine: {dr_chat.summary}",
-        max_turns=10  # Increase max_turns as needed
+    # The pharma chat needs the prescription, so it cannot start earlier, but posting the
+    # doctor's transcript to Discord overlaps with it instead of waiting for both chats
+    _, pharma_chat = await asyncio.gather(
+        send_messages(itertools.chain((("gmkatie", gm_message),), iter_messages(dr_chat)), channel_id),
+        asyncio.to_thread(
+            pharmabro.initiate_chat,
+            drsasha,
+            message=f"Based on the following prescription, please decide on the appropriate medicine: {dr_chat.summary}",
+            max_turns=10,  # Increase max_turns as needed
+            cache=response_cache
+        ),
     )
 
-    # Extract all messages from PHARMABRO's chat
-    pharma_messages = extract_messages(pharma_chat)
-
     # Optionally, initiate further chats if needed
     # For example, continue the conversation or conclude it
 
-    # Combine all messages in chronological order
-    all_messages = [("gmkatie", gm_message)] + dr_messages + pharma_messages
-
-    # Send all messages to Discord
-    await send_messages(all_messages, channel_id)
+    # Send the pharma messages once the doctor's have gone out, keeping chronological order
+    await send_messages(iter_messages(pharma_chat), channel_id)
 
     # Optionally, send a final message
     final_message = (
@@ -221,50 +206,19 @@ async def initiate_conversation(channel_id):
 @client_gmkatie.event
 async def on_ready():
     print(f"Logged in as {client_gmkatie.user} (GMKATIE)")
-    gmkatie_ready.set()
 
 @client_gmkatie.event
 async def on_message(message):
-    if message.author == client_gmkatie.user:
+    if message.author == client_gmkatie.user or message.webhook_id:
         return
 
     if message.content.strip().lower() == ".start":
         print("GMKATIE received .start command.")
         await initiate_conversation(message.channel.id)
 
-# Event handler for DrSasha bot
-@client_drsasha.event
-async def on_ready():
-    print(f"Logged in as {client_drsasha.user} (DrSasha)")
-    drsasha_ready.set()
-
-@client_drsasha.event
-async def on_message(message):
-    # Define DrSasha's message handling here if needed
-    pass
-
-# Event handler for PharmaBro bot
-@client_pharmabro.event
-async def on_ready():
-    print(f"Logged in as {client_pharmabro.user} (PharmaBro)")
-    pharmabro_ready.set()
-
-@client_pharmabro.event
-async def on_message(message):
-    # Define PharmaBro's message handling here if needed
-    pass
-
-# Run all three Discord clients concurrently
-async def run_bots():
-    await asyncio.gather(
-        client_gmkatie.start(DISCORD_TOKEN_GMKATIE),
-        client_drsasha.start(DISCORD_TOKEN_DRSASHA),
-        client_pharmabro.start(DISCORD_TOKEN_PHARMABRO),
-    )
-
 # Entry point
 if __name__ == "__main__":
     try:
-        asyncio.run(run_bots())
+        client_gmkatie.run(DISCORD_TOKEN_GMKATIE)
     except KeyboardInterrupt:
         print("Bots are shutting down.")
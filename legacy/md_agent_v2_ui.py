@@ -1,14 +1,23 @@
 import os
-from typing import Annotated, TypedDict, List, Dict, Any
+import json
+import logging
+from collections import Counter
+from typing import TypedDict, List, Dict, Any, Literal, Optional
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from pydantic import BaseModel, Field, ValidationError
 import streamlit as st
-from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
+from langchain_core.messages import HumanMessage, SystemMessage
+from langchain_core.output_parsers import JsonOutputParser
+from langchain_core.caches import InMemoryCache
+from langchain_core.globals import get_llm_cache, set_llm_cache
 from langchain_openai import AzureChatOpenAI
-import operator
 import dashscope
 import base64
 import requests
 
+logger = logging.getLogger(__name__)
+
 # Load environment variables
 load_dotenv()
 
@@ -24,13 +33,20 @@ st.set_page_config(
 llm = AzureChatOpenAI(
     api_key=os.getenv("AZURE_OAI_API_KEY"),
     deployment_name="gpt-4o",
-    api_version="2023-03-15-preview"
+    # Structured output needs tool calling, which 2023-03-15-preview lacks
+    api_version="2024-02-15-preview"
 )
+# Exact-match response cache for every llm call: a repeated case must match the whole
+# prompt, allergies and medications included. Streamlit re-executes this script on each
+# interaction, so only install it once per process.
+if get_llm_cache() is None:
+    set_llm_cache(InMemoryCache(maxsize=512))
+# Upper bound on simultaneous specialist calls, to stay within the Azure rate limits
+MAX_CONCURRENT_CALLS = 8
 
 # Define state management
 class DermState(TypedDict):
     """State for dermatology consultation flow"""
-    messages: Annotated[List[Any], operator.add]  # Chat history
     patient_data: dict  # Patient information
     complexity: str  # Complexity level
     members: List[dict]  # Medical team members
@@ -39,6 +55,128 @@ class DermState(TypedDict):
     final_diagnosis: str
     treatment_plan: str
 
+class TriageAssessment(BaseModel):
+    complexity: Literal["Low", "Moderate", "High"] = Field(description="Case complexity level")
+    rationale: str = Field(description="Brief rationale for the complexity level")
+    diagnosis: Optional[str] = Field(default=None, description="Low complexity only: clear diagnosis with key findings")
+    treatment_plan: Optional[str] = Field(default=None, description="Low complexity only: specific treatment recommendations")
+
+class DiagnosisOutput(BaseModel):
+    diagnosis: str = Field(description="Diagnosis with key findings")
+    treatment_plan: str = Field(description="Treatment recommendations")
+
+class SpecialistOpinion(BaseModel):
+    role: str = Field(description="Specialist role")
+    expertise: str = Field(description="Primary focus")
+    contribution: str = Field(description="Expected contribution")
+    diagnosis: str = Field(description="Diagnosis considerations from this specialty's perspective")
+    treatment_plan: str = Field(description="Treatment recommendations from this specialty's perspective")
+
+class TeamAssessment(BaseModel):
+    specialists: List[SpecialistOpinion] = Field(description="Recruited specialists with their initial assessments")
+
+triage_llm = llm.with_structured_output(TriageAssessment)
+team_llm = llm.with_structured_output(TeamAssessment)
+# JSON mode streams partial objects, unlike tool-call structured output, so the
+# diagnosis can render while it is being written
+diagnosis_stream_llm = llm.bind(response_format={"type": "json_object"}) | JsonOutputParser()
+
+# Static system prompts: all case data goes in the trailing HumanMessage so the
+# prompt prefix stays identical across calls and hits the provider's prompt cache
+TRIAGE_PROMPT = """You are a dermatology triage specialist. Based on the image description, classify case complexity as:
+    - Low: Standard conditions manageable by one dermatologist (e.g., mild eczema, acne, common rashes)
+    - Moderate: Complex cases needing multi-specialist collaboration (e.g., severe psoriasis, unusual rashes)
+    - High: Severe cases requiring coordinated multi-team approach (e.g., severe drug reactions, complex autoimmune conditions)
+    
+    Provide the complexity level and a brief rationale.
+    If the complexity is Low, also act as the treating dermatologist and provide the diagnosis
+    with key findings and a specific treatment plan; otherwise leave them empty."""
+
+SINGLE_DERMATOLOGIST_PROMPT = """You are a dermatologist handling a straightforward case.
+    Provide a complete assessment: a clear diagnosis with key findings
+    and specific treatment recommendations.
+    Respond with a JSON object with the string fields "diagnosis" and "treatment_plan"."""
+
+SPECIALIST_PROMPT = """You are a medical specialist on a dermatology consultation team.
+    Provide a focused assessment including:
+    1. Key observations from your specialty perspective
+    2. Diagnosis considerations
+    3. Treatment recommendations
+    
+    Format your response with clear DIAGNOSIS: and TREATMENT PLAN: sections."""
+
+DISCUSSION_PROMPT = """You are a medical specialist on a dermatology consultation team.
+    Review other specialists' opinions and provide:
+    1. Points of agreement/disagreement
+    2. Questions for specific specialists
+    3. Updated assessment based on discussion"""
+
+SYNTHESIS_PROMPT = """You are the lead dermatologist.
+    Synthesize all specialist inputs to provide a detailed diagnosis with key findings
+    and a comprehensive treatment approach.
+    Respond with a JSON object with the string fields "diagnosis" and "treatment_plan"."""
+
+TEAM_PROMPT = """You are a medical recruiter assembling a dermatology consultation team.
+    Recruit 3-4 relevant specialists for the case. For each specialist give their role,
+    primary expertise and expected contribution, and write that specialist's initial assessment:
+    diagnosis considerations from their specialty perspective and treatment recommendations."""
+
+RECRUITMENT_PROMPT = """You are a medical recruiter. Based on case complexity and patient needs:
+    - For moderate cases: Recruit 3-4 relevant specialists for group discussion
+    - For high complexity: Recruit 2-3 teams of specialists for multi-team consultation
+    
+    Provide your response in the following format:
+    SPECIALIST: [Role]
+    EXPERTISE: [Primary focus]
+    CONTRIBUTION: [Expected contribution]
+    
+    List each specialist separately with the exact headers shown above."""
+
+@st.cache_resource(show_spinner=False)
+def get_speculation_stats() -> Counter:
+    # Process-wide, so the hit rate survives reruns and new consultations
+    return Counter()
+
+def record_speculation(used: bool):
+    stats = get_speculation_stats()
+    stats["used" if used else "discarded"] += 1
+    total = stats["used"] + stats["discarded"]
+    logger.info(f"Speculative recruitment {'used' if used else 'discarded'}; hit rate {stats['used']}/{total}")
+
+def case_details(image_description: str, patient_info: dict) -> str:
+    # The raw image bytes are already summarized by the description
+    patient_fields = {k: v for k, v in patient_info.items() if k != "image_content"}
+    return f"""Image Description: {image_description}
+
+    Patient Information: {patient_fields}"""
+
+def stream_diagnosis(messages: List[Any], diagnosis_title: str, treatment_title: str) -> DiagnosisOutput:
+    """Render the diagnosis and treatment plan as they stream in"""
+    st.subheader(diagnosis_title)
+    diagnosis_placeholder = st.empty()
+    st.subheader(treatment_title)
+    treatment_placeholder = st.empty()
+
+    partial = {}
+    for partial in diagnosis_stream_llm.stream(messages):
+        if isinstance(partial, dict):
+            diagnosis_placeholder.write(partial.get("diagnosis", ""))
+            treatment_placeholder.write(partial.get("treatment_plan", ""))
+    try:
+        return DiagnosisOutput.model_validate(partial)
+    except ValidationError:
+        # JSON mode does not enforce the schema; keep whatever was streamed
+        fields = partial if isinstance(partial, dict) else {}
+        diagnosis = fields.get("diagnosis")
+        treatment = fields.get("treatment_plan")
+        fallback = DiagnosisOutput(
+            diagnosis=str(diagnosis) if diagnosis else (json.dumps(partial, ensure_ascii=False) if partial else "Format parsing error"),
+            treatment_plan=str(treatment) if treatment else "Treatment plan parsing error"
+        )
+        diagnosis_placeholder.write(fallback.diagnosis)
+        treatment_placeholder.write(fallback.treatment_plan)
+        return fallback
+
 def get_image_description(image_content: bytes) -> str:
     """Retrieve image description using GPT-4 Vision"""
     # Encode the image content to base64
@@ -121,32 +259,63 @@ def assess_complexity_node(state: DermState) -> DermState:
     st.image(image_content, use_column_width=True)
     st.write(image_description)
 
-    # Prepare the content for the LLM
-    assessment_prompt = f"""You are a dermatology triage specialist. Based on the following image description, classify case complexity as:
-    - Low: Standard conditions manageable by one dermatologist (e.g., mild eczema, acne, common rashes)
-    - Moderate: Complex cases needing multi-specialist collaboration (e.g., severe psoriasis, unusual rashes)
-    - High: Severe cases requiring coordinated multi-team approach (e.g., severe drug reactions, complex autoimmune conditions)
-    
-    Provide only complexity level and brief rationale.
-
-    Image Description: {image_description}
-
-    Patient Information: {patient_info}
-    """
-
     with st.spinner('Assessing case complexity...'):
-        assessment = llm.invoke([
-            SystemMessage(content=assessment_prompt)
+        # Recruit the team and its first opinions speculatively alongside triage, in one call;
+        # the team is discarded for low-complexity cases
+        case = case_details(image_description, patient_info)
+        pool = ThreadPoolExecutor(max_workers=1)
+        team_future = pool.submit(team_llm.invoke, [
+            SystemMessage(content=TEAM_PROMPT),
+            HumanMessage(content=case)
         ])
+        try:
+            assessment = triage_llm.invoke([
+                SystemMessage(content=TRIAGE_PROMPT),
+                HumanMessage(content=case)
+            ])
+        finally:
+            # Low cases never wait for the speculative call; it finishes in the background
+            pool.shutdown(wait=False)
     
-    complexity = assessment.content.split("\n")[0].strip()
+    complexity = assessment.complexity
     st.subheader("Case Complexity Assessment")
     st.write(f"**Complexity Level:** {complexity}")
-    st.write(assessment.content)
+    st.write(assessment.rationale)
+
+    if "low" in complexity.lower():
+        record_speculation(False)
+        # Low-complexity triage already includes the dermatologist's assessment
+        if assessment.diagnosis and assessment.treatment_plan:
+            st.subheader("Diagnosis")
+            st.write(assessment.diagnosis)
+            st.subheader("Treatment Plan")
+            st.write(assessment.treatment_plan)
+            state["final_diagnosis"] = assessment.diagnosis
+            state["treatment_plan"] = assessment.treatment_plan
+    else:
+        with st.spinner('Recruiting specialists...'):
+            try:
+                team = team_future.result()
+            except Exception as e:
+                # Leave the team empty so the case falls back to recruit_specialists
+                logger.warning(f"Speculative recruitment failed: {e}")
+                team = None
+        record_speculation(team is not None)
+
+        if team is not None:
+            st.subheader("Recruiting Specialist Team")
+            state["members"] = [
+                {"role": member.role, "status": "active", "expertise": member.expertise, "contribution": member.contribution}
+                for member in team.specialists
+            ]
+            state["opinions"] = {
+                member.role: f"DIAGNOSIS: {member.diagnosis}\n\nTREATMENT PLAN: {member.treatment_plan}"
+                for member in team.specialists
+            }
+            show_team(state["members"])
 
     # Update state
     state["complexity"] = complexity
-    state["messages"].append(AIMessage(content=assessment.content))
     return state
 
 def single_dermatologist_node(state: DermState) -> DermState:
@@ -159,86 +328,34 @@ def single_dermatologist_node(state: DermState) -> DermState:
     
     st.subheader("Primary Dermatologist Assessment")
     
-    assessment_prompt = f"""You are a dermatologist handling a straightforward case.
-    Provide a complete assessment in the following format:
-    
-    DIAGNOSIS:
-    [Clear diagnosis with key findings]
-    
-    TREATMENT PLAN:
-    [Specific treatment recommendations]
-
-    Image Description: {image_description}
-
-    Patient Information: {patient_info}
-    """
-
-    with st.spinner('Dermatologist is assessing the case...'):
-        assessment = llm.invoke([
-            SystemMessage(content=assessment_prompt)
-        ])
+    assessment = stream_diagnosis([
+        SystemMessage(content=SINGLE_DERMATOLOGIST_PROMPT),
+        HumanMessage(content=case_details(image_description, patient_info))
+    ], "Diagnosis", "Treatment Plan")
     
-    # Parse the diagnosis and treatment plan
-    try:
-        parts = assessment.content.split("DIAGNOSIS:")
-        if len(parts) > 1:
-            content = parts[1]
-            diagnosis_treatment = content.split("TREATMENT PLAN:")
-            if len(diagnosis_treatment) == 2:
-                diagnosis = diagnosis_treatment[0].strip()
-                treatment = diagnosis_treatment[1].strip()
-            else:
-                diagnosis = content.strip()
-                treatment = "Treatment plan parsing error"
-        else:
-            diagnosis = assessment.content
-            treatment = "Format parsing error"
-    except:
-        diagnosis = assessment.content
-        treatment = "Error parsing treatment plan"
-
-    # Display diagnosis and treatment plan
-    st.subheader("Diagnosis")
-    st.write(diagnosis)
-    st.subheader("Treatment Plan")
-    st.write(treatment)
+    diagnosis = assessment.diagnosis
+    treatment = assessment.treatment_plan
 
     # Update state
     state["final_diagnosis"] = diagnosis
     state["treatment_plan"] = treatment
-    state["messages"].append(AIMessage(content=assessment.content))
     return state
 
-def recruit_specialists_node(state: DermState) -> DermState:
-    """Recruits appropriate specialists based on complexity"""
-    complexity = state["complexity"]
-    patient_info = state["patient_data"]
-    
-    recruitment_prompt = """You are a medical recruiter. Based on case complexity and patient needs:
-    - For moderate cases: Recruit 3-4 relevant specialists for group discussion
-    - For high complexity: Recruit 2-3 teams of specialists for multi-team consultation
-    
-    Provide your response in the following format:
-    SPECIALIST: [Role]
-    EXPERTISE: [Primary focus]
-    CONTRIBUTION: [Expected contribution]
-    
-    List each specialist separately with the exact headers shown above."""
-    
-    st.subheader("Recruiting Specialist Team")
-    
-    with st.spinner('Recruiting specialists...'):
-        recruitment = llm.invoke([
-            SystemMessage(content=recruitment_prompt),
-            HumanMessage(content=f"""
+def recruitment_messages(complexity: str, patient_info: dict) -> List[Any]:
+    patient_fields = {k: v for k, v in patient_info.items() if k != "image_content"}
+    return [
+        SystemMessage(content=RECRUITMENT_PROMPT),
+        HumanMessage(content=f"""
             Complexity Level: {complexity}
-            Patient Information: {patient_info}""")
-        ])
-    
+            Patient Information: {patient_fields}""")
+    ]
+
+def parse_specialists(recruitment_content: str) -> List[dict]:
+    """Parse the recruiter's SPECIALIST/EXPERTISE/CONTRIBUTION blocks"""
     specialists = []
     current_specialist = {}
     
-    for line in recruitment.content.split("\n"):
+    for line in recruitment_content.split("\n"):
         line = line.strip()
         if line.startswith("SPECIALIST:"):
             if current_specialist:
@@ -256,14 +373,28 @@ def recruit_specialists_node(state: DermState) -> DermState:
                 
     if current_specialist:
         specialists.append(current_specialist)
-        
+    return specialists
+
+def show_team(specialists: List[dict]):
     st.success(f"Recruited {len(specialists)} team members")
     for specialist in specialists:
-        st.write(f"- **{specialist['role']}**: {specialist['expertise']}")
+        st.write(f"- **{specialist['role']}**: {specialist.get('expertise', '')}")
+
+def recruit_specialists_node(state: DermState) -> DermState:
+    """Recruits appropriate specialists based on complexity"""
+    complexity = state["complexity"]
+    patient_info = state["patient_data"]
+    
+    st.subheader("Recruiting Specialist Team")
+    
+    with st.spinner('Recruiting specialists...'):
+        recruitment = llm.invoke(recruitment_messages(complexity, patient_info))
+    
+    specialists = parse_specialists(recruitment.content)
+    show_team(specialists)
     
     # Update state
     state["members"] = specialists
-    state["messages"].append(AIMessage(content=recruitment.content))
     return state
 
 def facilitate_discussion_node(state: DermState) -> DermState:
@@ -280,55 +411,47 @@ def facilitate_discussion_node(state: DermState) -> DermState:
     
     st.subheader("Team Discussion")
     
-    # Gather initial opinions
+    # Gather initial opinions from anyone who did not give one at recruitment
+    case = case_details(image_description, patient_info)
+    pending = [specialist for specialist in specialists if specialist["role"] not in opinions]
+    opinion_requests = [
+        [
+            SystemMessage(content=SPECIALIST_PROMPT),
+            HumanMessage(content=f"Assume you are a {specialist['role']}.\n\n{case}")
+        ]
+        for specialist in pending
+    ]
+
+    if pending:
+        # The opinions are independent, so request them all at once
+        with st.spinner("Specialists are providing assessments..."):
+            initial_opinions = llm.batch(opinion_requests, config={"max_concurrency": MAX_CONCURRENT_CALLS})
+        for specialist, opinion in zip(pending, initial_opinions):
+            opinions[specialist["role"]] = opinion.content
     for specialist in specialists:
-        opinion_prompt = f"""You are a {specialist['role']}. 
-        Provide a focused assessment including:
-        1. Key observations from your specialty perspective
-        2. Diagnosis considerations
-        3. Treatment recommendations
-        
-        Format your response with clear DIAGNOSIS: and TREATMENT PLAN: sections.
-
-        Image Description: {image_description}
-
-        Patient Information: {patient_info}
-        """
-
-        with st.spinner(f"{specialist['role']} is providing assessment..."):
-            opinion = llm.invoke([
-                SystemMessage(content=opinion_prompt)
-            ])
-        opinions[specialist["role"]] = opinion.content
         st.write(f"**{specialist['role']}** assessment completed.")
             
     # Facilitate inter-specialist discussion if needed
     if "high" in complexity:
         st.subheader("Multi-team Consultation")
         for i in range(3):  # Maximum 3 discussion rounds
-            round_log = {}
-            for specialist in specialists:
-                other_opinions = {k:v for k,v in opinions.items() if k != specialist["role"]}
-                
-                response_prompt = f"""You are a {specialist['role']}.
-                Review other specialists' opinions and provide:
-                1. Points of agreement/disagreement
-                2. Questions for specific specialists
-                3. Updated assessment based on discussion
-
-                Image Description: {image_description}
-
-                Patient Information: {patient_info}
-
-                Other Opinions: {other_opinions}
-                """
+            # Every specialist responds to the previous round, so the round can run concurrently.
+            # The round's opinions are serialized once and shared, ahead of the role, so the
+            # requests also share a cacheable prefix.
+            round_opinions = json.dumps(opinions, ensure_ascii=False)
+            response_requests = [
+                [
+                    SystemMessage(content=DISCUSSION_PROMPT),
+                    HumanMessage(content=f"{case}\n\nTeam Opinions: {round_opinions}\n\n"
+                                         f"Assume you are a {specialist['role']}; your own entry above is your previous opinion.")
+                ]
+                for specialist in specialists
+            ]
 
-                with st.spinner(f"{specialist['role']} is participating in discussion..."):
-                    response = llm.invoke([
-                        SystemMessage(content=response_prompt)
-                    ])
-                round_log[specialist["role"]] = response.content
-                opinions[specialist["role"]] = response.content
+            with st.spinner(f"Specialists are discussing (round {i+1})..."):
+                responses = llm.batch(response_requests, config={"max_concurrency": MAX_CONCURRENT_CALLS})
+            round_log = {specialist["role"]: response.content for specialist, response in zip(specialists, responses)}
+            opinions.update(round_log)
             
             interaction_logs[f"Round {i+1}"] = round_log
             st.write(f"Consultation round {i+1} completed.")
@@ -336,7 +459,6 @@ def facilitate_discussion_node(state: DermState) -> DermState:
     # Update state
     state["opinions"] = opinions
     state["interaction_logs"] = interaction_logs
-    state["messages"].append(AIMessage(content=str(opinions)))
     return state
 
 def synthesize_decision_node(state: DermState) -> DermState:
@@ -351,55 +473,20 @@ def synthesize_decision_node(state: DermState) -> DermState:
     
     st.subheader("Synthesizing Final Decision")
     
-    final_decision_prompt = f"""You are the lead dermatologist.
-    Synthesize all specialist inputs to provide:
-    
-    DIAGNOSIS:
-    [Detailed diagnosis with key findings]
-    
-    TREATMENT PLAN:
-    [Comprehensive treatment approach]
-
-    Image Description: {image_description}
+    final_decision = stream_diagnosis([
+        SystemMessage(content=SYNTHESIS_PROMPT),
+        HumanMessage(content=f"""Image Description: {image_description}
 
     Case Complexity: {complexity}
-    Specialist Opinions: {opinions}
-    """
-
-    with st.spinner('Synthesizing final decision...'):
-        final_decision = llm.invoke([
-            SystemMessage(content=final_decision_prompt)
-        ])
-    
-    # Parse the diagnosis and treatment plan
-    try:
-        parts = final_decision.content.split("DIAGNOSIS:")
-        if len(parts) > 1:
-            content = parts[1]
-            diagnosis_treatment = content.split("TREATMENT PLAN:")
-            if len(diagnosis_treatment) == 2:
-                diagnosis = diagnosis_treatment[0].strip()
-                treatment = diagnosis_treatment[1].strip()
-            else:
-                diagnosis = content.strip()
-                treatment = "Treatment plan parsing error"
-        else:
-            diagnosis = final_decision.content
-            treatment = "Format parsing error"
-    except:
-        diagnosis = final_decision.content
-        treatment = "Error parsing treatment plan"
+    Specialist Opinions: {opinions}""")
+    ], "Final Diagnosis", "Final Treatment Plan")
     
-    # Display final diagnosis and treatment plan
-    st.subheader("Final Diagnosis")
-    st.write(diagnosis)
-    st.subheader("Final Treatment Plan")
-    st.write(treatment)
+    diagnosis = final_decision.diagnosis
+    treatment = final_decision.treatment_plan
         
     # Update state
     state["final_diagnosis"] = diagnosis
     state["treatment_plan"] = treatment
-    state["messages"].append(AIMessage(content=final_decision.content))
     return state
 
 def display_final_report(state: DermState):
@@ -550,7 +637,6 @@ def main():
 
             # Initialize state
             st.session_state["state"] = {
-                "messages": [],
                 "patient_data": patient_info,
                 "complexity": "",
                 "members": [],
@@ -570,8 +656,16 @@ def main():
         if node == "assess_complexity":
             state = assess_complexity_node(state)
             complexity = state["complexity"].lower()
-            if "low" in complexity:
+            if "low" in complexity and state["final_diagnosis"]:
+                st.session_state["node"] = "END"
+            elif "low" in complexity:
                 st.session_state["node"] = "single_dermatologist"
+            elif state["members"] and "moderate" in complexity:
+                # Moderate cases have no discussion rounds, and the team gave its opinions at recruitment
+                st.session_state["node"] = "synthesize_decision"
+            elif state["members"]:
+                # The team was already recruited during triage
+                st.session_state["node"] = "facilitate_discussion"
             else:
                 st.session_state["node"] = "recruit_specialists"
             st.session_state["state"] = state